@@ -0,0 +1,231 @@
+# asyncio fetch engine: one event loop, a bounded number of requests in flight
+import concurrent.futures
+import queue
+import threading
+import transport
+import lazy_imports
+import single_flight
+import scheduler
+import fastjson
+from lab4 import extract_lat_lon
+
+asyncio = lazy_imports.lazy_module("asyncio")
+# aiohttp is optional, and only loaded when the first request is made
+aiohttp = lazy_imports.lazy_module("aiohttp") if lazy_imports.module_available("aiohttp") else None
+
+CONCURRENCY = 20
+TIMEOUT = 10
+MAX_PENDING = 64
+
+
+class AsyncClient:
+    '''
+    the event loop's view of the network. With aiohttp installed requests are
+    native coroutines on one connection pool; without it they run on the
+    shared requests session in a thread pool no larger than the concurrency
+    limit, so the thread count never grows with the number of cities.
+    '''
+    def __init__(self, concurrency=CONCURRENCY, timeout=TIMEOUT):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.session = None
+        self.executor = None
+
+    async def __aenter__(self):
+        if aiohttp is not None:
+            connector = aiohttp.TCPConnector(limit=self.concurrency)
+            self.session = aiohttp.ClientSession(connector=connector)
+        else:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.session is not None:
+            await self.session.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def get_json(self, url, decode=None):
+        '''
+        requests go through the shared scheduler, so the timeout applies to
+        each attempt and failed attempts are retried within its budget.
+        '''
+        async with self.semaphore:
+            if self.session is not None:
+                return await scheduler.get_scheduler().get_json_async(self.session, url, self.timeout, decode)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, scheduler.get_json, url, self.timeout, decode)
+
+
+async def fetch_geolocation_async(client, city_name):
+    url = transport.geocoding_url(city_name)
+    data = await single_flight.geocode_flights.do_async(city_name, client.get_json, url, fastjson.decode_geocode)
+    return city_name, extract_lat_lon(data)
+
+
+async def fetch_weather_async(client, city, lat, lon):
+    start_date, end_date = transport.forecast_window()
+    url = transport.forecast_url(lat, lon, start_date, end_date)
+    key = (lat, lon, (start_date, end_date))
+    data = await single_flight.weather_flights.do_async(key, client.get_json, url, fastjson.decode_forecast)
+    return city, data
+
+
+async def fetch_city_forecast_async(client, city, coords=None):
+    if coords is None:
+        _, coords = await fetch_geolocation_async(client, city)
+    if tuple(coords) == (None, None):
+        return city, (coords, None)
+    _, data = await fetch_weather_async(client, city, *coords)
+    return city, (coords, data)
+
+
+async def _gather(make_jobs, concurrency, timeout, cancel_event, on_result=None):
+    '''
+    run every job and collect (key, value) pairs from the ones that finish.
+    Jobs that time out or fail are left out of the result, and setting
+    cancel_event (a threading.Event) cancels whatever is still pending.
+    on_result(key, value) is called as each job succeeds.
+    '''
+    async with AsyncClient(concurrency, timeout) as client:
+        tasks = [asyncio.ensure_future(job) for job in make_jobs(client)]
+        if on_result is not None:
+            for task in tasks:
+                task.add_done_callback(lambda task: _report(task, on_result))
+        watcher = None
+        if cancel_event is not None:
+            watcher = asyncio.ensure_future(_cancel_when_set(cancel_event, tasks))
+        outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+        if watcher is not None:
+            watcher.cancel()
+    return dict(outcome for outcome in outcomes if not isinstance(outcome, BaseException))
+
+
+def _report(task, on_result):
+    if not task.cancelled() and task.exception() is None:
+        on_result(*task.result())
+
+
+async def _cancel_when_set(cancel_event, tasks):
+    while not cancel_event.is_set():
+        await asyncio.sleep(0.1)
+    for task in tasks:
+        task.cancel()
+
+
+def get_geolocations_async(cities, concurrency=CONCURRENCY, timeout=TIMEOUT, cancel_event=None,
+                           on_result=None):
+    return asyncio.run(_gather(
+        lambda client: (fetch_geolocation_async(client, city) for city in cities),
+        concurrency, timeout, cancel_event, on_result))
+
+
+def get_weather_data_async(valid_geolocations, concurrency=CONCURRENCY, timeout=TIMEOUT, cancel_event=None,
+                           on_result=None):
+    return asyncio.run(_gather(
+        lambda client: (fetch_weather_async(client, city, lat, lon)
+                        for city, (lat, lon) in valid_geolocations.items()),
+        concurrency, timeout, cancel_event, on_result))
+
+
+
+def _stream(make_job, inputs, concurrency, timeout, max_pending, cancel_event):
+    '''
+    run make_job(client, item) for each item of inputs on an event loop in a
+    background thread and yield the (key, value) pairs back to the calling
+    thread as they finish. A new job is only started when one of the
+    max_pending slots is free, and a slot is only freed once its result has
+    been taken, so a slow consumer holds back the input.
+    '''
+    results = queue.Queue()
+    finished = object()
+    ready = threading.Event()
+    stop = threading.Event()
+    state = {}
+
+    def stopped():
+        return stop.is_set() or (cancel_event is not None and cancel_event.is_set())
+
+    async def produce():
+        state["loop"] = asyncio.get_running_loop()
+        state["slots"] = slots = asyncio.Semaphore(max_pending)
+        state["tasks"] = tasks = set()
+        ready.set()
+        try:
+            async with AsyncClient(concurrency, timeout) as client:
+                for item in inputs:
+                    await slots.acquire()
+                    if stopped():
+                        break
+                    task = asyncio.ensure_future(make_job(client, item))
+                    tasks.add(task)
+                    task.add_done_callback(lambda task: (tasks.discard(task), results.put(task)))
+                if tasks:
+                    await asyncio.wait(set(tasks))
+        finally:
+            results.put(finished)
+
+    def cancel_all():
+        state["slots"].release()
+        for task in list(state["tasks"]):
+            task.cancel()
+
+    thread = threading.Thread(target=asyncio.run, args=(produce(),), daemon=True)
+    thread.start()
+    ready.wait()
+    try:
+        while True:
+            try:
+                task = results.get(timeout=0.1)
+            except queue.Empty:
+                if stopped():
+                    return
+                continue
+            if task is finished:
+                return
+            _call_soon(state["loop"], state["slots"].release)
+            if stopped():
+                return
+            if not task.cancelled() and task.exception() is None:
+                yield task.result()
+    finally:
+        stop.set()
+        _call_soon(state["loop"], cancel_all)
+        thread.join()
+
+
+def _call_soon(loop, callback):
+    # the loop may already have closed once the last result was queued
+    try:
+        loop.call_soon_threadsafe(callback)
+    except RuntimeError:
+        pass
+
+
+def iter_geolocations_async(cities, concurrency=CONCURRENCY, timeout=TIMEOUT, max_pending=MAX_PENDING,
+                            cancel_event=None):
+    '''
+    yield (city, (lat, lon)) as each lookup finishes.
+    '''
+    return _stream(fetch_geolocation_async, cities, concurrency, timeout, max_pending, cancel_event)
+
+
+def iter_weather_data_async(locations, concurrency=CONCURRENCY, timeout=TIMEOUT, max_pending=MAX_PENDING,
+                            cancel_event=None):
+    '''
+    yield (city, forecast) for each (city, (lat, lon)) in locations as it
+    arrives.
+    '''
+    return _stream(lambda client, location: fetch_weather_async(client, location[0], *location[1]),
+                   locations, concurrency, timeout, max_pending, cancel_event)
+
+
+def iter_city_forecasts_async(locations, concurrency=CONCURRENCY, timeout=TIMEOUT, max_pending=MAX_PENDING,
+                              cancel_event=None):
+    '''
+    yield (city, (coords, forecast)) for each (city, coords or None) in
+    locations; a city's forecast request goes out as soon as it is placed.
+    '''
+    return _stream(lambda client, location: fetch_city_forecast_async(client, *location),
+                   locations, concurrency, timeout, max_pending, cancel_event)
@@ -0,0 +1,56 @@
+# Batched forecast requests: many cities per call to the forecast API
+import transport
+import scheduler
+import fastjson
+
+BATCH_SIZE = 50
+
+
+def chunk_locations(valid_geolocations, chunk_size=BATCH_SIZE):
+    '''
+    split the {city: (lat, lon)} dict into lists of (city, lat, lon) with at
+    most chunk_size cities each.
+    '''
+    return list(iter_chunks(valid_geolocations.items(), chunk_size))
+
+
+def iter_chunks(locations, chunk_size=BATCH_SIZE):
+    '''
+    the same chunks, built lazily from any iterable of (city, (lat, lon)).
+    '''
+    chunk = []
+    for city, (lat, lon) in locations:
+        chunk.append((city, lat, lon))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def fetch_weather_batch(chunk):
+    '''
+    one forecast request for every (city, lat, lon) in chunk. The API answers
+    a list of locations with a JSON array in the same order, and a single
+    location with a plain object, so both are handled.
+    '''
+    start_date, end_date = transport.forecast_window()
+    latitudes = ",".join(str(lat) for _, lat, _ in chunk)
+    longitudes = ",".join(str(lon) for _, _, lon in chunk)
+    url = transport.forecast_url(latitudes, longitudes, start_date, end_date)
+    return split_batch_response(chunk, scheduler.get_json(url, decode=fastjson.decode_forecast))
+
+
+def split_batch_response(chunk, data):
+    if isinstance(data, dict):
+        data = [data]
+    if len(data) != len(chunk):
+        raise ValueError(f"expected {len(chunk)} locations in batch response, got {len(data)}")
+    return {city: location for (city, _, _), location in zip(chunk, data)}
+
+
+def get_weather_data_batched(valid_geolocations, chunk_size=BATCH_SIZE):
+    weather_data = {}
+    for chunk in chunk_locations(valid_geolocations, chunk_size):
+        weather_data.update(fetch_weather_batch(chunk))
+    return weather_data
@@ -0,0 +1,283 @@
+# Offline benchmark of every fetch mode against the local stub server
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import stub_server
+import lab4
+import lab4thread
+import lab4process
+import async_engine
+import batch
+import pools
+import transport
+import metrics
+import pipeline
+import fastjson
+
+MODES = ("serial", "threaded", "process", "asyncio", "batched", "pipelined")
+
+
+def geocode_functions():
+    # geocoding has no multi-city request, so batched mode geocodes on the thread pool
+    return {
+        "serial": lab4.get_geolocations,
+        "threaded": lab4thread.get_geolocations_threaded,
+        "process": lab4process.get_geolocations_multiprocessing,
+        "asyncio": async_engine.get_geolocations_async,
+        "batched": lab4thread.get_geolocations_threaded,
+    }
+
+
+def weather_functions():
+    return {
+        "serial": lab4.get_weather_data,
+        "threaded": lab4thread.get_weather_data_threaded,
+        "process": lab4process.get_weather_data_multiprocessing,
+        "asyncio": async_engine.get_weather_data_async,
+        "batched": lambda valid_geolocations: batch.get_weather_data_batched(valid_geolocations),
+    }
+
+
+def end_to_end_function(mode, geocode, fetch_many):
+    '''
+    cities in, forecasts out. The pipelined mode geocodes and forecasts each
+    city in one chain on the thread pool; the others run their geocode
+    stage to completion before their forecast stage starts.
+    '''
+    if mode == "pipelined":
+        return lambda cities: {city: data for city, _, data in pipeline.iter_city_forecasts(
+            cities, None, None, lab4thread.iter_city_forecasts_threaded) if data is not None}
+    return lambda cities: fetch_many(lab4.filter_valid_geolocations(geocode(cities)))
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(mode, stage, count, samples):
+    median = percentile(samples, 0.5)
+    return {
+        "mode": mode,
+        "stage": stage,
+        "cities": count,
+        "samples": len(samples),
+        "mean_s": statistics.fmean(samples),
+        "p50_s": median,
+        "p95_s": percentile(samples, 0.95),
+        "p99_s": percentile(samples, 0.99),
+        "throughput_per_s": count / median if median else None,
+    }
+
+
+def time_call(function, argument, warmup, repeats):
+    for _ in range(warmup):
+        function(argument)
+    samples = []
+    result = None
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = function(argument)
+        samples.append(time.perf_counter() - start_time)
+    return samples, result
+
+
+def run(modes=MODES, sizes=(10, 100), warmup=1, repeats=5, latency=0.02, jitter=0.005):
+    '''
+    time the geocode and forecast stages of each mode for each city count,
+    and both together end to end, and return the results together with the
+    settings they were taken with. The pipelined mode only has the end to
+    end stage since its stages overlap.
+    Every mode sees the same stub server, city names and coordinates. The
+    real endpoints are restored afterwards and the worker pools are shut
+    down so no worker keeps pointing at the stub.
+    '''
+    endpoints = transport.GEOCODING_URL, transport.FORECAST_URL
+    server = stub_server.start_stub_server(latency=latency, jitter=jitter)
+    stub_server.use_stub_server(server)
+    geocoders = geocode_functions()
+    fetchers = weather_functions()
+    results = []
+    try:
+        for count in sizes:
+            cities = [f"City {index}" for index in range(count)]
+            for mode in modes:
+                if mode in geocoders:
+                    samples, geolocations = time_call(geocoders[mode], cities, warmup, repeats)
+                    results.append(summarize(mode, "geocode", count, samples))
+                    valid_geolocations = lab4.filter_valid_geolocations(geolocations)
+                    samples, _ = time_call(fetchers[mode], valid_geolocations, warmup, repeats)
+                    results.append(summarize(mode, "forecast", count, samples))
+                end_to_end = end_to_end_function(mode, geocoders.get(mode), fetchers.get(mode))
+                samples, _ = time_call(end_to_end, cities, warmup, repeats)
+                results.append(summarize(mode, "end_to_end", count, samples))
+    finally:
+        server.shutdown()
+        transport.GEOCODING_URL, transport.FORECAST_URL = endpoints
+        transport.close_session()
+        pools.shutdown_pools()
+    return {"meta": run_metadata(latency, jitter, warmup, repeats), "results": results}
+
+
+def run_metadata(latency, jitter, warmup, repeats):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "latency_s": latency,
+        "jitter_s": jitter,
+        "warmup": warmup,
+        "repeats": repeats,
+        "timestamp": time.time(),
+    }
+
+
+def decode_benchmark(count=1000, repeats=5):
+    '''
+    microbenchmark of forecast decoding: the json module and the fastjson
+    backend parsing whole responses against fastjson.decode_forecast keeping
+    only the fields the app reads. Reports the best time per response and
+    the memory each decoded forecast keeps alive.
+    '''
+    start_date, end_date = (str(day) for day in transport.forecast_window())
+    bodies = [json.dumps(stub_server.forecast_response(37 + index / 1000, -122, start_date, end_date)).encode()
+              for index in range(count)]
+    decoders = {
+        "json (full)": json.loads,
+        f"{fastjson.BACKEND} (full)": fastjson.loads,
+        f"{fastjson.BACKEND} (selective)": fastjson.decode_forecast,
+    }
+    rows = []
+    for name, decode in decoders.items():
+        samples = []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            for body in bodies:
+                decode(body)
+            samples.append(time.perf_counter() - start_time)
+        tracemalloc.start()
+        decoded = [decode(body) for body in bodies]
+        retained = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del decoded
+        rows.append({"decoder": name, "us_per_response": min(samples) / count * 1e6,
+                     "bytes_per_forecast": retained / count})
+    return rows
+
+
+def print_decode_table(rows):
+    print(f"{'decoder':<24}{'us/response':>14}{'bytes/forecast':>16}")
+    for row in rows:
+        print(f"{row['decoder']:<24}{row['us_per_response']:>14.1f}{row['bytes_per_forecast']:>16.0f}")
+
+
+def startup_benchmark(modules=("lab4thread", "lab4process"), repeats=5):
+    '''
+    median time, in fresh interpreters, to import each app module and to get
+    from launching it as a script to its first drawn window. The window time
+    is None where Tk cannot open a display.
+    '''
+    directory = os.path.dirname(os.path.abspath(__file__))
+    rows = []
+    for module in modules:
+        imports = []
+        windows = []
+        for _ in range(repeats):
+            code = f"import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)"
+            output = subprocess.run([sys.executable, "-c", code], cwd=directory, capture_output=True,
+                                    text=True, check=True).stdout
+            imports.append(float(output))
+            start_time = time.perf_counter()
+            process = subprocess.Popen([sys.executable, f"{module}.py", "--first-window"], cwd=directory,
+                                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            line = process.stdout.readline()
+            elapsed = time.perf_counter() - start_time
+            process.wait()
+            if line.strip() == "first window":
+                windows.append(elapsed)
+        rows.append({"module": module, "import_s": statistics.median(imports),
+                     "first_window_s": statistics.median(windows) if windows else None})
+    return rows
+
+
+def print_startup_table(rows):
+    print(f"{'module':<16}{'import (s)':>12}{'first window (s)':>18}")
+    for row in rows:
+        window = "n/a" if row["first_window_s"] is None else f"{row['first_window_s']:.4f}"
+        print(f"{row['module']:<16}{row['import_s']:>12.4f}{window:>18}")
+
+
+def print_table(report, baseline=None):
+    '''
+    print p50 per stage and mode. With a baseline report from another run,
+    the change against it is shown next to each number.
+    '''
+    previous = {}
+    if baseline is not None:
+        previous = {(row["mode"], row["stage"], row["cities"]): row for row in baseline["results"]}
+    print(f"{'mode':<12}{'stage':<12}{'cities':>8}{'p50 (s)':>12}{'p95 (s)':>12}{'p99 (s)':>12}"
+          f"{'cities/s':>12}{'vs base':>10}")
+    for row in report["results"]:
+        base = previous.get((row["mode"], row["stage"], row["cities"]))
+        change = f"{(row['p50_s'] / base['p50_s'] - 1) * 100:+.1f}%" if base else ""
+        print(f"{row['mode']:<12}{row['stage']:<12}{row['cities']:>8}{row['p50_s']:>12.4f}"
+              f"{row['p95_s']:>12.4f}{row['p99_s']:>12.4f}{row['throughput_per_s']:>12.1f}{change:>10}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the fetch modes against a local stub API.")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma-separated subset of " + ",".join(MODES))
+    parser.add_argument("--sizes", default="10,100", help="comma-separated city counts, e.g. 10,100,1000,10000")
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.02, help="stub response delay in seconds")
+    parser.add_argument("--jitter", type=float, default=0.005, help="+/- random delay in seconds")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="JSON report from an earlier run to compare against")
+    parser.add_argument("--decode", action="store_true", help="also run the JSON decode microbenchmark")
+    parser.add_argument("--startup", action="store_true",
+                        help="also time importing the app modules and opening their first window")
+    parser.add_argument("--metrics", help="collect per-stage metrics and write them to this path "
+                                          "(.json for JSON, anything else for Prometheus text)")
+    args = parser.parse_args(argv)
+    if args.metrics:
+        metrics.enable()
+        metrics.add_sink(metrics.FileSink(args.metrics, "json" if args.metrics.endswith(".json") else "prometheus"))
+
+    report = run(modes=args.modes.split(","), sizes=[int(size) for size in args.sizes.split(",")],
+                 warmup=args.warmup, repeats=args.repeats, latency=args.latency, jitter=args.jitter)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+    print_table(report, baseline)
+    if args.decode:
+        report["decode"] = decode_benchmark()
+        print()
+        print_decode_table(report["decode"])
+    if args.startup:
+        report["startup"] = startup_benchmark()
+        print()
+        print_startup_table(report["startup"])
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    metrics.flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+# Columnar forecast store: one contiguous float array per daily variable
+import datetime
+import warnings
+import numpy as np
+
+VARIABLES = ("temperature_2m_max", "temperature_2m_min", "windspeed_10m_max", "uv_index_max")
+
+_COMPARISONS = {
+    ">": np.greater,
+    ">=": np.greater_equal,
+    "<": np.less,
+    "<=": np.less_equal,
+    "==": np.equal,
+}
+
+
+class ForecastTable:
+    '''
+    daily forecasts for many cities as a city x day grid. Each variable is one
+    float64 array of shape (len(cities), n_days), day 0 is base_date, and days
+    a city has no forecast for are NaN and False in present. Rows follow the
+    order of cities.
+    '''
+    def __init__(self, cities, base_date, columns, present):
+        self.cities = list(cities)
+        self.city_index = {city: row for row, city in enumerate(self.cities)}
+        self.base_date = base_date
+        self.columns = columns
+        self.present = present
+
+    @classmethod
+    def from_weather_data(cls, weather_data):
+        '''
+        build the table from the {city: forecast} dicts the fetch functions
+        return. ISO dates become integer offsets from the earliest date seen.
+        '''
+        cities = list(weather_data)
+        ordinal_of = {}
+        rows, ordinals = [], []
+        values = {name: [] for name in VARIABLES}
+        for row, data in enumerate(weather_data.values()):
+            daily = data['daily']
+            days = daily['time']
+            for day in days:
+                ordinal = ordinal_of.get(day)
+                if ordinal is None:
+                    ordinal = ordinal_of[day] = datetime.date.fromisoformat(day).toordinal()
+                ordinals.append(ordinal)
+            rows.extend([row] * len(days))
+            for name in VARIABLES:
+                if len(daily[name]) != len(days):
+                    raise ValueError(f"{name} has {len(daily[name])} values for {len(days)} days")
+                values[name].extend(daily[name])
+        if not ordinals:
+            return cls(cities, None, {name: np.empty((len(cities), 0)) for name in VARIABLES},
+                       np.zeros((len(cities), 0), dtype=bool))
+        # every city's days and values go into the grid with one scatter per variable
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        first = int(ordinals.min())
+        offsets = ordinals - first
+        rows = np.asarray(rows, dtype=np.int64)
+        n_days = int(offsets.max()) + 1
+        columns = {name: np.full((len(cities), n_days), np.nan) for name in VARIABLES}
+        present = np.zeros((len(cities), n_days), dtype=bool)
+        present[rows, offsets] = True
+        for name in VARIABLES:
+            columns[name][rows, offsets] = np.asarray(values[name], dtype=np.float64)
+        return cls(cities, datetime.date.fromordinal(first), columns, present)
+
+    @property
+    def n_days(self):
+        return next(iter(self.columns.values())).shape[1]
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self.columns.values()) + self.present.nbytes
+
+    def day_offset(self, day):
+        if isinstance(day, str):
+            day = datetime.date.fromisoformat(day)
+        return (day - self.base_date).days
+
+    def dates(self):
+        return [str(self.base_date + datetime.timedelta(days=offset)) for offset in range(self.n_days)]
+
+    def window(self, variable, start_date=None, end_date=None):
+        '''
+        the variable's columns between start_date and end_date inclusive.
+        '''
+        start = 0 if start_date is None else max(self.day_offset(start_date), 0)
+        end = self.n_days if end_date is None else min(self.day_offset(end_date) + 1, self.n_days)
+        return self.columns[variable][:, start:max(start, end)]
+
+    def cities_where(self, variable, op, threshold, start_date=None, end_date=None):
+        '''
+        cities with at least one day in the window where variable op threshold,
+        for example cities_where("temperature_2m_max", ">", 90).
+        '''
+        mask = _COMPARISONS[op](self.window(variable, start_date, end_date), threshold).any(axis=1)
+        return [self.cities[row] for row in np.flatnonzero(mask)]
+
+    def stats(self, variable, start_date=None, end_date=None):
+        '''
+        {"mean": ..., "min": ..., "max": ...} arrays with one value per city,
+        ignoring missing days. Cities with no data in the window get NaN.
+        '''
+        values = self.window(variable, start_date, end_date)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return {"mean": np.nanmean(values, axis=1),
+                    "min": np.nanmin(values, axis=1),
+                    "max": np.nanmax(values, axis=1)}
+
+    def city_forecast(self, city):
+        '''
+        one city's forecast in the {'daily': {...}} shape show_weather_display
+        reads, with missing days left out.
+        '''
+        row = self.city_index[city]
+        present = self.present[row]
+        dates = self.dates()
+        daily = {"time": [dates[offset] for offset in np.flatnonzero(present)]}
+        for name in VARIABLES:
+            daily[name] = self.columns[name][row, present].tolist()
+        return {"daily": daily}
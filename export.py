@@ -0,0 +1,261 @@
+# Bulk export of stored forecasts to CSV, the weather.txt layout or a columnar file
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import zipfile
+import numpy as np
+import columnar
+import lazy_imports
+import weather_log
+
+# Parquet needs pyarrow; without it the columnar export is a NumPy .npz file
+pyarrow = lazy_imports.lazy_module("pyarrow") if lazy_imports.module_available("pyarrow") else None
+parquet = lazy_imports.lazy_module("pyarrow.parquet") if pyarrow is not None else None
+
+CHUNK_CITIES = 2000
+BUFFER_SIZE = 1 << 20
+EXPORT_STATE_FILE = 'export_state.json'
+FORMATS = ("csv", "txt", "parquet")
+COLUMNS = ("city", "date") + columnar.VARIABLES
+
+
+def iter_chunks(weather_data, cities=None, chunk_size=CHUNK_CITIES):
+    '''
+    {city: forecast} dicts of at most chunk_size cities each, taken from
+    weather_data one chunk at a time so memory does not grow with the number
+    of cities. cities limits and orders the export; by default every city
+    in weather_data is included.
+    '''
+    cities = iter(weather_data if cities is None else cities)
+    while True:
+        chunk = {city: weather_data[city] for city in itertools.islice(cities, chunk_size)}
+        if not chunk:
+            return
+        yield chunk
+
+
+def city_days(chunk):
+    '''
+    the chunk's city-days as flat lists: city, ISO date and one list of the
+    stored values per variable, with None where the API left a value out.
+    Only the days each city has are listed, so the size follows the number
+    of city-days and not the span of dates.
+    '''
+    cities, dates = [], []
+    values = {name: [] for name in columnar.VARIABLES}
+    for city, data in chunk.items():
+        daily = data['daily']
+        days = daily['time']
+        cities.extend([city] * len(days))
+        dates.extend(days)
+        for name in columnar.VARIABLES:
+            if len(daily[name]) != len(days):
+                raise ValueError(f"{city}: {name} has {len(daily[name])} values for {len(days)} days")
+            values[name].extend(daily[name])
+    return cities, dates, values
+
+
+def write_csv(path, chunks, append=False):
+    '''
+    one row per city-day: city, date and the four daily variables, written
+    as stored. The rows are formatted by the csv module value by value;
+    only the columnar export works on whole arrays. Returns the number of rows written. With append set, rows
+    are added to an existing file and the header is only written to a new
+    one.
+    '''
+    count = 0
+    write_header = not (append and os.path.exists(path) and os.path.getsize(path))
+    with open(path, 'a' if append else 'w', newline='', buffering=BUFFER_SIZE) as file:
+        writer = csv.writer(file)
+        if write_header:
+            writer.writerow(("city", "date") + columnar.VARIABLES)
+        for chunk in chunks:
+            cities, dates, values = city_days(chunk)
+            writer.writerows(zip(cities, dates, *(values[name] for name in columnar.VARIABLES)))
+            count += len(cities)
+    return count
+
+
+def write_weather_txt(path, chunks, append=False):
+    '''
+    the layout on_close has always written: for each city its name, then a
+    line of dates and one line per variable, then a blank line, with every
+    value formatted by str() as before. This is not vectorised: values are
+    formatted one by one so the output stays byte-identical (an integer
+    stays 70, not 70.0), but each chunk is formatted in memory and written
+    with a single call instead of a write per line.
+    '''
+    count = 0
+    with open(path, 'a' if append else 'w', buffering=BUFFER_SIZE) as file:
+        for chunk in chunks:
+            parts = []
+            for city, data in chunk.items():
+                daily = data['daily']
+                parts.append(f"{city}:\n")
+                parts.append(",".join(daily['time']) + "\n")
+                parts.extend(",".join(map(str, daily[name])) + "\n" for name in columnar.VARIABLES)
+                parts.append("\n")
+                count += len(daily['time'])
+            file.write("".join(parts))
+    return count
+
+
+def write_columnar(path, chunks, append=False):
+    '''
+    a Parquet file with one row group per chunk when pyarrow is installed,
+    otherwise a .npz file with one set of column arrays per chunk (path's
+    extension is changed to .npz). Neither can be appended to, so with
+    append set the rows go to a new numbered part file next to path
+    (out.part0001.npz, out.part0002.npz, ...). Returns (path written, rows
+    written).
+    '''
+    if pyarrow is None:
+        path = os.path.splitext(path)[0] + ".npz"
+    if append:
+        path = _next_part(path)
+    if pyarrow is not None:
+        return path, _write_parquet(path, chunks)
+    return path, _write_npz(path, chunks)
+
+
+def _next_part(path):
+    stem, extension = os.path.splitext(path)
+    for number in itertools.count(1):
+        part = f"{stem}.part{number:04d}{extension}"
+        if not os.path.exists(part):
+            return part
+
+
+def _columns(chunk):
+    cities, dates, values = city_days(chunk)
+    arrays = {"city": np.asarray(cities, dtype=str), "date": np.asarray(dates, dtype='datetime64[D]')}
+    arrays.update((name, np.asarray(values[name], dtype=np.float64)) for name in columnar.VARIABLES)
+    return arrays
+
+
+def _write_npz(path, chunks):
+    # each chunk's arrays are written as their own members (0000/city.npy,
+    # 0000/date.npy, ...) as soon as the chunk is converted, so only one
+    # chunk is held in memory; np.savez would need every array at once
+    count = 0
+    temp_path = path + ".tmp"
+    with zipfile.ZipFile(temp_path, 'w', allowZip64=True) as archive:
+        for number, chunk in enumerate(chunks):
+            arrays = _columns(chunk)
+            for column, array in arrays.items():
+                with archive.open(f"{number:04d}/{column}.npy", 'w', force_zip64=True) as member:
+                    np.lib.format.write_array(member, array, allow_pickle=False)
+            count += len(arrays["city"])
+    os.replace(temp_path, path)
+    return count
+
+
+def iter_npz_chunks(path):
+    '''
+    the chunks of a .npz export in the order they were written, each a
+    {column: array} dict with the columns "city", "date" and the variables.
+    '''
+    with np.load(path) as archive:
+        for number in sorted({name.partition("/")[0] for name in archive.files}):
+            yield {column: archive[f"{number}/{column}"] for column in COLUMNS}
+
+
+def _write_parquet(path, chunks):
+    schema = pyarrow.schema([("city", pyarrow.string()), ("date", pyarrow.date32())] +
+                            [(name, pyarrow.float64()) for name in columnar.VARIABLES])
+    count = 0
+    with parquet.ParquetWriter(path, schema) as writer:
+        for chunk in chunks:
+            arrays = _columns(chunk)
+            # from_pandas stores NaN (a value the API left out) as null
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(arrays[column], schema.field(column).type, from_pandas=True) for column in COLUMNS],
+                schema=schema))
+            count += len(arrays["city"])
+    return count
+
+
+def export(weather_data, path, format=None, cities=None, append=False, chunk_size=CHUNK_CITIES):
+    '''
+    write weather_data (or only the given cities) to path as csv, txt (the
+    weather.txt layout) or parquet, taking the format from the extension if
+    it is not given. Returns (path written, city-days written).
+    '''
+    format = format or _format_for(path)
+    chunks = iter_chunks(weather_data, cities, chunk_size)
+    if format == "csv":
+        return path, write_csv(path, chunks, append)
+    if format == "txt":
+        return path, write_weather_txt(path, chunks, append)
+    if format == "parquet":
+        return write_columnar(path, chunks, append)
+    raise ValueError(f"unknown export format {format!r}")
+
+
+def _format_for(path):
+    extension = os.path.splitext(path)[1].lower().lstrip(".")
+    return {"csv": "csv", "txt": "txt", "parquet": "parquet", "npz": "parquet"}.get(extension, "csv")
+
+
+def load_export_state(state_file=EXPORT_STATE_FILE):
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as file:
+            return json.load(file)
+    return {}
+
+
+def save_export_state(state, state_file=EXPORT_STATE_FILE):
+    temp_filename = state_file + ".tmp"
+    with open(temp_filename, 'w') as file:
+        json.dump(state, file)
+    os.replace(temp_filename, state_file)
+
+
+def export_since_last(log, path, format=None, state_file=EXPORT_STATE_FILE, chunk_size=CHUNK_CITIES):
+    '''
+    export only the cities whose weather log record is newer than the last
+    export to path, appending them for csv and txt and writing them to a
+    new part file for parquet. The highest record sequence number exported
+    is kept per path in state_file. Returns (path written, city-days
+    written).
+    '''
+    state = load_export_state(state_file)
+    key = os.path.abspath(path)
+    since = state.get(key, 0)
+    cities = [city for city, seq in log.record_seq.items() if seq > since]
+    if not cities:
+        return path, 0
+    written = export(log.index, path, format, cities, append=True, chunk_size=chunk_size)
+    state[key] = max(log.record_seq[city] for city in cities)
+    save_export_state(state, state_file)
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export stored forecasts to CSV, weather.txt or a columnar file.")
+    parser.add_argument("output", help="file to write; .csv, .txt or .parquet")
+    parser.add_argument("--format", choices=FORMATS, help="override the format taken from the extension")
+    parser.add_argument("--weather-log", default=weather_log.WEATHER_LOG_FILE)
+    parser.add_argument("--snapshot", default=weather_log.SNAPSHOT_FILE)
+    parser.add_argument("--since-last", action="store_true",
+                        help="only export cities stored since the last --since-last export to this file")
+    parser.add_argument("--state-file", default=EXPORT_STATE_FILE)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_CITIES)
+    args = parser.parse_args(argv)
+
+    snapshot_filename = args.snapshot if os.path.exists(args.snapshot) else None
+    log = weather_log.WeatherLog(args.weather_log, snapshot_filename=snapshot_filename)
+    log.load()
+    if args.since_last:
+        path, count = export_since_last(log, args.output, args.format, args.state_file, args.chunk_size)
+    else:
+        path, count = export(log.index, args.output, args.format, chunk_size=args.chunk_size)
+    print(f"{count} city-days written to {path}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+# JSON backend (orjson or msgspec when installed, the json module otherwise)
+# and decoders that keep only the fields the app reads from API responses
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+GEOCODE_FIELDS = ("latitude", "longitude", "country", "admin1")
+DAILY_FIELDS = ("time", "temperature_2m_max", "temperature_2m_min", "windspeed_10m_max", "uv_index_max")
+
+if orjson is not None:
+    BACKEND = "orjson"
+    DecodeError = orjson.JSONDecodeError
+    loads = orjson.loads
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+elif msgspec is not None:
+    BACKEND = "msgspec"
+    DecodeError = (ValueError, msgspec.DecodeError)
+    loads = msgspec.json.Decoder().decode
+    _encoder = msgspec.json.Encoder()
+
+    def dumps(obj):
+        return _encoder.encode(obj).decode()
+else:
+    BACKEND = "json"
+    DecodeError = ValueError
+    loads = json.loads
+    dumps = json.dumps
+
+
+def compact_geocode(data):
+    '''
+    {"results": [...]} with each result cut down to GEOCODE_FIELDS.
+    '''
+    return {"results": [{field: result.get(field) for field in GEOCODE_FIELDS}
+                        for result in data.get("results", [])]}
+
+
+def compact_forecast(data):
+    '''
+    a forecast cut down to its coordinates and the DAILY_FIELDS arrays. A
+    list, as returned for a batch of locations, is compacted item by item.
+    '''
+    if isinstance(data, list):
+        return [compact_forecast(location) for location in data]
+    daily = data.get("daily", {})
+    return {
+        "latitude": data.get("latitude"),
+        "longitude": data.get("longitude"),
+        "daily": {field: daily.get(field) for field in DAILY_FIELDS},
+    }
+
+
+if msgspec is not None:
+    from typing import List, Optional, Union
+
+    # msgspec skips everything not declared here while decoding, so the
+    # unused parts of a response are never turned into Python objects
+    class _GeocodeResult(msgspec.Struct):
+        latitude: float
+        longitude: float
+        country: Optional[str] = None
+        admin1: Optional[str] = None
+
+    class _GeocodeResponse(msgspec.Struct):
+        results: List[_GeocodeResult] = msgspec.field(default_factory=list)
+
+    class _Daily(msgspec.Struct):
+        time: List[str]
+        temperature_2m_max: List[Optional[float]]
+        temperature_2m_min: List[Optional[float]]
+        windspeed_10m_max: List[Optional[float]]
+        uv_index_max: List[Optional[float]]
+
+    class _Forecast(msgspec.Struct):
+        latitude: float
+        longitude: float
+        daily: _Daily
+
+    _geocode_decoder = msgspec.json.Decoder(_GeocodeResponse)
+    _forecast_decoder = msgspec.json.Decoder(Union[_Forecast, List[_Forecast]])
+
+    def decode_geocode(body):
+        return msgspec.to_builtins(_geocode_decoder.decode(body))
+
+    def decode_forecast(body):
+        return msgspec.to_builtins(_forecast_decoder.decode(body))
+else:
+    def decode_geocode(body):
+        return compact_geocode(loads(body))
+
+    def decode_forecast(body):
+        return compact_forecast(loads(body))
@@ -0,0 +1,183 @@
+# On-disk forecast cache with a time-to-live and least-recently-used eviction
+import collections
+import os
+import threading
+import time
+import transport
+import spatial_index
+import metrics
+import fastjson
+
+FORECAST_CACHE_FILE = 'forecast_cache.json'
+UNITS = "fahrenheit,mph"
+
+
+class ForecastCache:
+    '''
+    forecasts keyed on rounded latitude/longitude, units and the
+    start_date/end_date window. Entries older than ttl seconds are treated as
+    missing, and once there are more than max_entries the least recently used
+    ones are dropped. With radius_km set, a miss falls back to the nearest
+    fresh entry for the same units and window within that distance, since
+    points a few km apart usually land in the same forecast grid cell.
+    '''
+    def __init__(self, filename=FORECAST_CACHE_FILE, ttl=3600, max_entries=1000, precision=2, radius_km=0):
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.precision = precision
+        self.radius_km = radius_km
+        self.entries = collections.OrderedDict()
+        self.spatial = spatial_index.GridIndex()
+        self.lock = threading.Lock()
+        # the app and the prefetch thread may both save
+        self.save_lock = threading.Lock()
+        self.hits = 0
+        self.nearby_hits = 0
+        self.misses = 0
+        self.load()
+
+    def key(self, latitude, longitude, start_date, end_date, units=UNITS):
+        return (f"{round(float(latitude), self.precision)},{round(float(longitude), self.precision)},"
+                f"{units},{start_date},{end_date}")
+
+    def get(self, latitude, longitude, start_date, end_date, units=UNITS):
+        key = self.key(latitude, longitude, start_date, end_date, units)
+        with self.lock:
+            data = self._fresh(key)
+            if data is None and self.radius_km:
+                data = self._nearby(latitude, longitude, f"{units},{start_date},{end_date}")
+                if data is not None:
+                    self.nearby_hits += 1
+            if data is None:
+                self.misses += 1
+                metrics.increment("forecast_cache_miss")
+                return None
+            self.hits += 1
+            metrics.increment("forecast_cache_hit")
+            return data
+
+    def _fresh(self, key):
+        entry = self.entries.get(key)
+        if entry is None or time.time() - entry["fetched_at"] > self.ttl:
+            return None
+        self.entries.move_to_end(key)
+        return entry["data"]
+
+    def _nearby(self, latitude, longitude, suffix):
+        for _, key in self.spatial.within(float(latitude), float(longitude), self.radius_km):
+            if key.split(",", 2)[2] == suffix:
+                data = self._fresh(key)
+                if data is not None:
+                    return data
+        return None
+
+    def put(self, latitude, longitude, start_date, end_date, data, units=UNITS, fetched_at=None, meta=None):
+        '''
+        store data for the location and window. meta is what the response
+        said about itself (ETag, Last-Modified, generationtime_ms, timezone)
+        and is kept for conditional refreshes.
+        '''
+        key = self.key(latitude, longitude, start_date, end_date, units)
+        entry = {"fetched_at": time.time() if fetched_at is None else fetched_at, "data": data}
+        if meta:
+            entry["meta"] = meta
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self._index(key)
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                lat, lon = evicted.split(",")[:2]
+                self.spatial.remove(float(lat), float(lon), evicted)
+
+    def entry(self, latitude, longitude, start_date, end_date, units=UNITS):
+        '''
+        the stored entry ({"fetched_at", "data", "meta"}) whether or not it is
+        still fresh, or None. Used by refreshes, so it does not count as a hit
+        or miss.
+        '''
+        key = self.key(latitude, longitude, start_date, end_date, units)
+        with self.lock:
+            return self.entries.get(key)
+
+    def touch(self, latitude, longitude, start_date, end_date, meta=None, units=UNITS):
+        '''
+        mark an entry as fetched now without replacing its data, for a
+        refresh that found the forecast unchanged. Returns False if there is
+        no entry to touch.
+        '''
+        key = self.key(latitude, longitude, start_date, end_date, units)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+            entry["fetched_at"] = time.time()
+            if meta:
+                entry["meta"] = meta
+            self.entries.move_to_end(key)
+            return True
+
+    def _index(self, key):
+        lat, lon = key.split(",")[:2]
+        self.spatial.insert(float(lat), float(lon), key)
+
+    def seed(self, weather_data, geolocations, saved_at):
+        '''
+        add forecasts that were stored before the cache saw them, such as the
+        ones in the weather log. The window comes from each forecast's own
+        dates and saved_at maps each city to the time it was stored. Records
+        already past the ttl are skipped before their forecast is read, so a
+        lazily loaded store only decodes the recent ones.
+        '''
+        now = time.time()
+        for city, stored_at in saved_at.items():
+            coords = geolocations.get(city)
+            if now - stored_at > self.ttl or not coords or coords[0] is None or city not in weather_data:
+                continue
+            data = weather_data[city]
+            dates = data.get('daily', {}).get('time')
+            if not dates:
+                continue
+            key = self.key(coords[0], coords[1], dates[0], dates[-1])
+            if key not in self.entries:
+                self.put(coords[0], coords[1], dates[0], dates[-1], data, fetched_at=saved_at[city])
+
+    def load(self):
+        if os.path.exists(self.filename):
+            with open(self.filename, 'rb') as file:
+                self.entries.update(fastjson.loads(file.read()))
+            for key in self.entries:
+                self._index(key)
+
+    def save(self):
+        temp_filename = self.filename + ".tmp"
+        with self.save_lock:
+            with self.lock:
+                snapshot = dict(self.entries)
+            with open(temp_filename, 'w') as file:
+                file.write(fastjson.dumps(snapshot))
+            os.replace(temp_filename, self.filename)
+
+
+def iter_weather_data_cached(valid_geolocations, cache, iter_fetch):
+    '''
+    yield (city, forecast) for the fresh cache entries straight away, then
+    for the rest as iter_fetch (any of the iter_weather_data_* functions)
+    produces them, storing each new result in cache. The cache file is
+    rewritten once the stream is exhausted.
+    '''
+    start_date, end_date = transport.forecast_window()
+    missing = {}
+    for city, (lat, lon) in valid_geolocations.items():
+        data = cache.get(lat, lon, start_date, end_date)
+        if data is None:
+            missing[city] = (lat, lon)
+        else:
+            yield city, data
+    if missing:
+        for city, data in iter_fetch(missing.items()):
+            lat, lon = missing[city]
+            cache.put(lat, lon, start_date, end_date, data)
+            yield city, data
+        cache.save()
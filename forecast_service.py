@@ -0,0 +1,307 @@
+# Local forecast service: every client on the machine shares one warm cache and one upstream pool
+import argparse
+import sys
+import time
+from urllib.parse import parse_qs, urlparse
+import async_engine
+import batch
+import fastjson
+import forecast_cache
+import geocode_store
+import lazy_imports
+import single_flight
+import transport
+from lab4 import extract_lat_lon
+
+asyncio = lazy_imports.lazy_module("asyncio")
+
+HOST = "127.0.0.1"
+PORT = 8765
+SAVE_INTERVAL = 60
+MAX_SEARCHES = 10000
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           502: "Bad Gateway"}
+
+
+class BadRequest(Exception):
+    pass
+
+
+class ForecastService:
+    '''
+    answers geocoding and forecast queries from a shared in-memory cache,
+    going upstream only for what is missing, through one AsyncClient (so one
+    connection pool and the scheduler's rate limits) for all clients.
+
+    /v1/search and /v1/forecast take the same parameters as the Open-Meteo
+    APIs and answer the same (compacted) bodies, so any client can use the
+    service by pointing GEOCODING_URL and FORECAST_URL at it. Forecasts are
+    always for the app's daily variables and units. Several locations in
+    one /v1/forecast query are fetched upstream as one batch request.
+    /geocode and /forecast take city names (repeated name= or city=
+    parameters, or a POSTed {"cities": [...]}) and answer {city: value},
+    with null for a city that could not be placed.
+    '''
+    def __init__(self, cache=None, store=None, concurrency=async_engine.CONCURRENCY,
+                 timeout=async_engine.TIMEOUT):
+        self.cache = cache if cache is not None else forecast_cache.ForecastCache()
+        self.store = store if store is not None else geocode_store.GeocodeStore()
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.client = None
+        self.searches = {}
+        self.dirty = False
+        self.requests = 0
+        self.upstream_requests = 0
+        self.started_at = time.time()
+
+    async def upstream(self, url, decode):
+        self.upstream_requests += 1
+        return await self.client.get_json(url, decode)
+
+    async def search(self, name):
+        '''
+        the geocoding API's answer for name, cut down to the fields the app
+        reads.
+        '''
+        data = self.searches.get(name)
+        if data is None:
+            data = await single_flight.geocode_flights.do_async(
+                name, self.upstream, transport.geocoding_url(name), fastjson.decode_geocode)
+            if len(self.searches) >= MAX_SEARCHES:
+                self.searches.pop(next(iter(self.searches)))
+            self.searches[name] = data
+        return data
+
+    async def geocode(self, cities):
+        '''
+        {city: (lat, lon) or (None, None)} for cities, looked up in the
+        geocode store first. Cities whose lookup failed are left out.
+        '''
+        geolocations = {}
+        missing = []
+        for city in cities:
+            coords = self.store.lookup(city)
+            if coords is None:
+                missing.append(city)
+            else:
+                geolocations[city] = coords
+        outcomes = await asyncio.gather(*(self.search(city) for city in missing), return_exceptions=True)
+        for city, outcome in zip(missing, outcomes):
+            if isinstance(outcome, BaseException):
+                continue
+            self.store.add(city, extract_lat_lon(outcome))
+            geolocations[city] = self.store.lookup(city)
+            self.dirty = True
+        return geolocations
+
+    async def forecasts(self, coordinates, start_date, end_date):
+        '''
+        the forecast for each (lat, lon) in coordinates, in order. The ones
+        not in the cache are fetched in batches of batch.BATCH_SIZE
+        locations per upstream request.
+        '''
+        results = [self.cache.get(lat, lon, start_date, end_date) for lat, lon in coordinates]
+        missing = [i for i, data in enumerate(results) if data is None]
+        chunks = [missing[i:i + batch.BATCH_SIZE] for i in range(0, len(missing), batch.BATCH_SIZE)]
+        fetched = await asyncio.gather(*(self.fetch_batch([coordinates[i] for i in chunk], start_date, end_date)
+                                         for chunk in chunks))
+        for chunk, forecasts in zip(chunks, fetched):
+            for i, data in zip(chunk, forecasts):
+                lat, lon = coordinates[i]
+                self.cache.put(lat, lon, start_date, end_date, data)
+                results[i] = data
+        if missing:
+            self.dirty = True
+        return results
+
+    async def fetch_batch(self, coordinates, start_date, end_date):
+        latitudes = ",".join(str(lat) for lat, _ in coordinates)
+        longitudes = ",".join(str(lon) for _, lon in coordinates)
+        url = transport.forecast_url(latitudes, longitudes, start_date, end_date)
+        # the single-location key matches async_engine's, so both coalesce
+        key = (coordinates[0][0], coordinates[0][1], (start_date, end_date)) if len(coordinates) == 1 else url
+        data = await single_flight.weather_flights.do_async(key, self.upstream, url, fastjson.decode_forecast)
+        chunk = [(i, lat, lon) for i, (lat, lon) in enumerate(coordinates)]
+        return list(batch.split_batch_response(chunk, data).values())
+
+    async def city_forecasts(self, cities):
+        start_date, end_date = transport.forecast_window()
+        geolocations = await self.geocode(cities)
+        placed = [city for city in cities if city in geolocations and geolocations[city][0] is not None]
+        forecasts = await self.forecasts([geolocations[city] for city in placed], start_date, end_date)
+        weather_data = dict.fromkeys(cities)
+        weather_data.update(zip(placed, forecasts))
+        return weather_data
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "upstream_requests": self.upstream_requests,
+            "forecast_cache": {"entries": len(self.cache.entries), "hits": self.cache.hits,
+                               "nearby_hits": self.cache.nearby_hits, "misses": self.cache.misses},
+            "geocodes": len(self.store.geolocations),
+            "single_flight": {"geocode": single_flight.geocode_flights.stats(),
+                              "weather": single_flight.weather_flights.stats()},
+            "uptime": time.time() - self.started_at,
+        }
+
+    async def dispatch(self, method, target, body):
+        '''
+        (status, JSON-able body) for one request.
+        '''
+        url = urlparse(target)
+        query = parse_qs(url.query)
+        posted = fastjson.loads(body) if method == "POST" and body else {}
+        if method not in ("GET", "POST"):
+            return 405, {"error": True, "reason": f"{method} is not supported"}
+        if url.path == "/v1/search":
+            return 200, await self.search(_one(query, "name"))
+        if url.path == "/v1/forecast":
+            return 200, await self.open_meteo_forecast(query)
+        if url.path == "/geocode":
+            cities = _cities(query, posted, "name")
+            return 200, {city: list(coords) if coords[0] is not None else None
+                         for city, coords in (await self.geocode(cities)).items()}
+        if url.path == "/forecast":
+            return 200, await self.city_forecasts(_cities(query, posted, "city"))
+        if url.path == "/stats":
+            return 200, self.stats()
+        return 404, {"error": True, "reason": f"no such endpoint {url.path}"}
+
+    async def open_meteo_forecast(self, query):
+        latitudes = _one(query, "latitude").split(",")
+        longitudes = _one(query, "longitude").split(",")
+        if len(latitudes) != len(longitudes):
+            raise BadRequest("latitude and longitude must have the same number of values")
+        try:
+            coordinates = [(float(lat), float(lon)) for lat, lon in zip(latitudes, longitudes)]
+        except ValueError:
+            raise BadRequest("latitude and longitude must be numbers")
+        default_start, default_end = transport.forecast_window()
+        start_date = query.get("start_date", [str(default_start)])[0]
+        end_date = query.get("end_date", [str(default_end)])[0]
+        forecasts = await self.forecasts(coordinates, start_date, end_date)
+        return forecasts[0] if len(forecasts) == 1 else forecasts
+
+    async def handle(self, reader, writer):
+        '''
+        serve HTTP/1.1 requests on one connection until the client closes
+        it or asks for Connection: close.
+        '''
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, target, version = request_line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                self.requests += 1
+                try:
+                    status, payload = await self.dispatch(method, target, body)
+                except (BadRequest, fastjson.DecodeError) as error:
+                    status, payload = 400, {"error": True, "reason": str(error)}
+                except Exception as error:
+                    status, payload = 502, {"error": True, "reason": f"upstream request failed: {error}"}
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                data = fastjson.dumps(payload).encode()
+                writer.write((f"HTTP/1.1 {status} {REASONS[status]}\r\n"
+                              f"Content-Type: application/json\r\n"
+                              f"Content-Length: {len(data)}\r\n"
+                              f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode() + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def save(self):
+        if self.dirty:
+            self.dirty = False
+            self.cache.save()
+            self.store.save()
+
+    async def save_periodically(self, interval):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval)
+            await loop.run_in_executor(None, self.save)
+
+    async def serve(self, host=HOST, port=PORT, ready=None, save_interval=SAVE_INTERVAL):
+        '''
+        run until cancelled. ready, if given, is called with the bound
+        (host, port) once the service accepts connections.
+        '''
+        async with async_engine.AsyncClient(self.concurrency, self.timeout) as client:
+            self.client = client
+            server = await asyncio.start_server(self.handle, host, port)
+            saver = asyncio.ensure_future(self.save_periodically(save_interval))
+            try:
+                async with server:
+                    if ready is not None:
+                        ready(server.sockets[0].getsockname()[:2])
+                    await server.serve_forever()
+            finally:
+                saver.cancel()
+                self.save()
+
+
+def _one(query, name):
+    values = query.get(name)
+    if not values or not values[0]:
+        raise BadRequest(f"missing parameter {name}")
+    return values[0]
+
+
+def _cities(query, posted, name):
+    cities = posted.get("cities") if isinstance(posted, dict) else None
+    cities = cities or query.get(name) or query.get("cities")
+    if not cities:
+        raise BadRequest(f"give one or more {name}= parameters or POST {{\"cities\": [...]}}")
+    return cities
+
+
+def use_service(base_url):
+    '''
+    send this process's geocoding and forecast requests to a running
+    service instead of the Open-Meteo APIs.
+    '''
+    base_url = base_url.rstrip("/")
+    transport.set_endpoints(base_url + "/v1/search", base_url + "/v1/forecast")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve geocodes and forecasts from one shared cache.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--cache-ttl", type=float, default=3600)
+    parser.add_argument("--max-entries", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=async_engine.CONCURRENCY)
+    args = parser.parse_args(argv)
+
+    service = ForecastService(forecast_cache.ForecastCache(ttl=args.cache_ttl, max_entries=args.max_entries),
+                              concurrency=args.concurrency)
+
+    def ready(address):
+        print(f"serving on http://{address[0]}:{address[1]}; clients can set "
+              f"GEOCODING_URL=http://{address[0]}:{address[1]}/v1/search and "
+              f"FORECAST_URL=http://{address[0]}:{address[1]}/v1/forecast", file=sys.stderr)
+
+    try:
+        asyncio.run(service.serve(args.host, args.port, ready))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
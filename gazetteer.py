@@ -0,0 +1,163 @@
+# Offline geocoder: a bundled place list indexed by normalised name and name prefix
+import argparse
+import bisect
+import csv
+import collections
+import functools
+import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+
+GAZETTEER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gazetteer.csv')
+# the region extract_lat_lon picks out of the geocoding API's results
+COUNTRY = "United States"
+ADMIN1 = "California"
+PREFIX_LIMIT = 10
+
+# common abbreviations, so "St Helena" and "Mt. Shasta" find the full names
+_ABBREVIATIONS = {"st": "saint", "ste": "sainte", "mt": "mount", "ft": "fort"}
+_SEPARATORS = re.compile(r"[\s\-.,'’/()]+")
+
+Place = collections.namedtuple("Place", "name country country_code admin1 latitude longitude population")
+
+
+@functools.lru_cache(maxsize=4096)
+def normalize(name):
+    '''
+    the form names are indexed under: accents removed, case folded,
+    punctuation treated as spaces and common abbreviations expanded, so
+    "San José", "san jose" and "SAN-JOSE" are the same key.
+    '''
+    decomposed = unicodedata.normalize("NFKD", name)
+    plain = "".join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+    words = [_ABBREVIATIONS.get(word, word) for word in _SEPARATORS.split(plain) if word]
+    return " ".join(words)
+
+
+class Gazetteer:
+    '''
+    the places in a gazetteer CSV (name, alternate_names, country,
+    country_code, admin1, latitude, longitude, population), indexed in
+    memory. lookup() finds places by whole name through a dict of
+    normalised names and alternate names; complete() finds them by the
+    start of a name with a bisect over the sorted keys. Both can be
+    limited to a country (name or code) and admin1, and list the most
+    populous place first.
+    '''
+    def __init__(self, filename=GAZETTEER_FILE):
+        self.filename = filename
+        self.places = []
+        index = collections.defaultdict(list)
+        with open(filename, 'r', newline='', encoding='utf-8') as file:
+            for row in csv.DictReader(file):
+                place = Place(row["name"], row["country"], row["country_code"], row["admin1"],
+                              float(row["latitude"]), float(row["longitude"]), int(row["population"] or 0))
+                self.places.append(place)
+                names = [place.name] + [name for name in row["alternate_names"].split(";") if name]
+                for key in dict.fromkeys(normalize(name) for name in names):
+                    index[key].append(place)
+        for places in index.values():
+            places.sort(key=lambda place: -place.population)
+        self.index = dict(index)
+        self.keys = sorted(self.index)
+
+    def lookup(self, name, country=None, admin1=None):
+        '''
+        the places called name (or with it as an alternate name) in country
+        and admin1 when they are given.
+        '''
+        return _filtered(self.index.get(normalize(name), ()), country, admin1)
+
+    def locate(self, name, country=None, admin1=None):
+        '''
+        (lat, lon) of the most populous match for name, or None.
+        '''
+        places = self.lookup(name, country, admin1)
+        return (places[0].latitude, places[0].longitude) if places else None
+
+    def complete(self, prefix, country=None, admin1=None, limit=PREFIX_LIMIT):
+        '''
+        up to limit places whose normalised name or alternate name starts
+        with prefix, in name order.
+        '''
+        prefix = normalize(prefix)
+        found = []
+        seen = set()
+        for position in range(bisect.bisect_left(self.keys, prefix), len(self.keys)):
+            key = self.keys[position]
+            if not key.startswith(prefix):
+                break
+            for place in _filtered(self.index[key], country, admin1):
+                if place not in seen:
+                    seen.add(place)
+                    found.append(place)
+                    if len(found) >= limit:
+                        return found
+        return found
+
+
+def _filtered(places, country, admin1):
+    if country is not None:
+        country = normalize(country)
+        places = [place for place in places
+                  if country in (normalize(place.country), normalize(place.country_code))]
+    if admin1 is not None:
+        admin1 = normalize(admin1)
+        places = [place for place in places if normalize(place.admin1) == admin1]
+    return list(places)
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer():
+    '''
+    the bundled gazetteer, loaded the first time it is needed.
+    '''
+    global _gazetteer
+    with _gazetteer_lock:
+        if _gazetteer is None:
+            _gazetteer = Gazetteer()
+        return _gazetteer
+
+
+def locate(city, country=COUNTRY, admin1=ADMIN1):
+    '''
+    (lat, lon) for city in the app's region from the bundled gazetteer, or
+    None if it is not listed and has to be looked up online.
+    '''
+    return get_gazetteer().locate(city, country, admin1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Look up places in the bundled gazetteer.")
+    parser.add_argument("names", nargs="+")
+    parser.add_argument("--country", help="country name or code; any country when not given")
+    parser.add_argument("--admin1", help="state or province; any when not given")
+    parser.add_argument("--prefix", action="store_true", help="treat each name as the start of a place name")
+    parser.add_argument("--file", default=GAZETTEER_FILE)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    gazetteer = Gazetteer(args.file)
+    print(f"{len(gazetteer.places)} places loaded in {(time.perf_counter() - started) * 1000:.1f} ms",
+          file=sys.stderr)
+    for name in args.names:
+        started = time.perf_counter()
+        if args.prefix:
+            places = gazetteer.complete(name, args.country, args.admin1)
+        else:
+            places = gazetteer.lookup(name, args.country, args.admin1)
+        elapsed = (time.perf_counter() - started) * 1e6
+        print(f"{name}: {len(places)} found in {elapsed:.0f} us")
+        for place in places:
+            print(f"  {place.name}, {place.admin1}, {place.country}: {place.latitude}, {place.longitude}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
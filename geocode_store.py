@@ -0,0 +1,112 @@
+# Incremental geocode store: only cities it has not seen are looked up
+import json
+import os
+import threading
+import time
+import gazetteer
+import metrics
+
+GEOLOCATION_FILE = 'geolocations.json'
+
+
+class GeocodeStore:
+    '''
+    the {city: [lat, lon]} map in geolocations.json, filled in a few cities at
+    a time. Cities the API could not place are kept as [null, null] like
+    before, and their expiry times live in a small side file so they are
+    retried once negative_ttl seconds have passed. A city it has not seen
+    is looked up with local (by default the bundled gazetteer) before it is
+    reported as missing, so the API is only asked about unlisted places;
+    pass local=None to always ask the API.
+    '''
+    def __init__(self, filename=GEOLOCATION_FILE, negative_ttl=86400, local=gazetteer.locate):
+        self.filename = filename
+        self.local = local
+        self.misses_filename = os.path.splitext(filename)[0] + ".misses.json"
+        self.negative_ttl = negative_ttl
+        self.geolocations = {}
+        self.negative_expiry = {}
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'r') as file:
+            stored = json.load(file)
+        if os.path.exists(self.misses_filename):
+            with open(self.misses_filename, 'r') as file:
+                self.negative_expiry = json.load(file)
+        default_expiry = os.path.getmtime(self.filename) + self.negative_ttl
+        for city, coords in stored.items():
+            if coords is None or coords[0] is None:
+                self.negative_expiry.setdefault(city, default_expiry)
+            else:
+                self.geolocations[city] = tuple(coords)
+
+    def save(self):
+        with metrics.timer("save_geolocations"):
+            self._save()
+
+    def _save(self):
+        with self.lock:
+            stored = {city: list(coords) for city, coords in self.geolocations.items()}
+            stored.update({city: [None, None] for city in self.negative_expiry})
+            misses = dict(self.negative_expiry)
+        for filename, data in ((self.filename, stored), (self.misses_filename, misses)):
+            temp_filename = filename + ".tmp"
+            with open(temp_filename, 'w') as file:
+                json.dump(data, file)
+            os.replace(temp_filename, filename)
+
+    def lookup(self, city):
+        '''
+        (lat, lon) for a known city, (None, None) for a city with an
+        unexpired negative result, or None if it still has to be looked up.
+        '''
+        with self.lock:
+            if city in self.geolocations:
+                return self.geolocations[city]
+            expires_at = self.negative_expiry.get(city)
+            if expires_at is not None and expires_at > time.time():
+                return None, None
+        coords = self.local(city) if self.local is not None else None
+        if coords is None:
+            return None
+        metrics.increment("geocode_gazetteer_hit")
+        self.add(city, coords)
+        return tuple(coords)
+
+    def add(self, city, coords):
+        with self.lock:
+            if coords is None or coords[0] is None:
+                self.negative_expiry[city] = time.time() + self.negative_ttl
+                self.geolocations.pop(city, None)
+            else:
+                self.geolocations[city] = tuple(coords)
+                self.negative_expiry.pop(city, None)
+
+    def resolve(self, cities, fetch_many):
+        '''
+        return {city: (lat, lon)} for every city in cities, calling fetch_many
+        (any of the get_geolocations_* functions) only for the cities that are
+        missing. Cities whose lookup failed outright are left out and will be
+        tried again next time.
+        '''
+        geolocations = {}
+        missing = []
+        for city in cities:
+            coords = self.lookup(city)
+            if coords is None:
+                missing.append(city)
+                metrics.increment("geocode_cache_miss")
+            else:
+                geolocations[city] = coords
+                metrics.increment("geocode_cache_hit")
+        if missing:
+            fetched = fetch_many(missing)
+            for city, coords in fetched.items():
+                self.add(city, coords)
+                geolocations[city] = self.lookup(city)
+            self.save()
+        return geolocations
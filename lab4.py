@@ -1,29 +1,44 @@
-import requests
+import transport
+import scheduler
+import fastjson
+import metrics
+import batch
+import geocode_store
+import pipeline
 import datetime
 import json
 import os
+import lazy_imports
+
+requests = lazy_imports.lazy_module("requests")
 
 GEOLOCATION_FILE = 'geolocations.json'
+CITIES = ["Napa", "Sonoma", "Santa Cruz", "Monterey", "Berkeley", "Livermore",
+          "San Francisco", "San Mateo", "San Jose", "Los Gatos"]
 
 # Step 1: Fetch geolocation data for the cities
 def fetch_geolocation(city_name):
-    url = f"https://geocoding-api.open-meteo.com/v1/search?name={city_name}&count=10&language=en&format=json"
-    response = requests.get(url)
-    return response.json()
+    url = f"{transport.GEOCODING_URL}?name={city_name}&count=10&language=en&format=json"
+    with metrics.timer("fetch_geolocation"):
+        return scheduler.get_json(url, decode=fastjson.decode_geocode)
 
 def extract_lat_lon(geolocation_data):
-    for result in geolocation_data.get('results', []):
-        if result['country'] == "United States" and result['admin1'] == "California":
-            return result['latitude'], result['longitude']
-    return None, None
+    with metrics.timer("extract_lat_lon"):
+        for result in geolocation_data.get('results', []):
+            if result['country'] == "United States" and result['admin1'] == "California":
+                return result['latitude'], result['longitude']
+        return None, None
 
-def get_geolocations(cities):
-    geolocations = {}
+def iter_geolocations(cities):
     for city in cities:
-        data = fetch_geolocation(city)
-        lat_lon = extract_lat_lon(data)
-        geolocations[city] = lat_lon
-    return geolocations
+        try:
+            data = fetch_geolocation(city)
+        except requests.RequestException:
+            continue
+        yield city, extract_lat_lon(data)
+
+def get_geolocations(cities):
+    return dict(iter_geolocations(cities))
 
 def save_geolocations_to_file(geolocations, filename):
     with open(filename, 'w') as file:
@@ -37,49 +52,68 @@ def load_geolocations_from_file(filename):
 
 # Step 2: Filter out cities without valid geolocation data
 def filter_valid_geolocations(geolocations):
-    return {city: coords for city, coords in geolocations.items() if coords != (None, None)}
+    return {city: coords for city, coords in geolocations.items() if tuple(coords) != (None, None)}
 
 # Step 3: Fetch weather data for the cities
 def fetch_weather(latitude, longitude):
     start_date = datetime.datetime.now().date()
     end_date = start_date + datetime.timedelta(days=4)
-    url = (f"https://api.open-meteo.com/v1/forecast?"
+    url = (f"{transport.FORECAST_URL}?"
            f"latitude={latitude}&longitude={longitude}&"
            f"daily=temperature_2m_max,temperature_2m_min,windspeed_10m_max,uv_index_max&"
            f"temperature_unit=fahrenheit&wind_speed_unit=mph&timezone=auto&"
            f"start_date={start_date}&end_date={end_date}")
-    response = requests.get(url)
-    return response.json()
+    with metrics.timer("fetch_weather"):
+        return scheduler.get_json(url, decode=fastjson.decode_forecast)
 
-def get_weather_data(valid_geolocations):
-    return {city: fetch_weather(lat, lon) for city, (lat, lon) in valid_geolocations.items()}
+def iter_weather_data(locations, batch_size=None):
+    if batch_size:
+        for chunk in batch.iter_chunks(locations, batch_size):
+            yield from batch.fetch_weather_batch(chunk).items()
+        return
+    for city, (lat, lon) in locations:
+        try:
+            yield city, fetch_weather(lat, lon)
+        except requests.RequestException:
+            continue
+
+def get_weather_data(valid_geolocations, batch_size=None):
+    if batch_size:
+        return batch.get_weather_data_batched(valid_geolocations, batch_size)
+    return dict(iter_weather_data(valid_geolocations.items()))
+
+def fetch_city_forecast(city, coords=None):
+    '''
+    geocode city unless coords are already known, then fetch its forecast.
+    Returns (coords, forecast); forecast is None when the city could not be
+    placed.
+    '''
+    if coords is None:
+        coords = extract_lat_lon(fetch_geolocation(city))
+    if tuple(coords) == (None, None):
+        return coords, None
+    return coords, fetch_weather(*coords)
+
+def iter_city_forecasts(locations, cancel_event=None):
+    for city, coords in locations:
+        if cancel_event is not None and cancel_event.is_set():
+            return
+        try:
+            yield city, fetch_city_forecast(city, coords)
+        except requests.RequestException:
+            continue
 
 # Main function to orchestrate the steps
 def main():
-    cities = ["Napa", "Sonoma", "Santa Cruz", "Monterey", "Berkeley", "Livermore", 
-              "San Francisco", "San Mateo", "San Jose", "Los Gatos"]
-    
-    # Load geolocations from file if it exists
-    geolocations = load_geolocations_from_file(GEOLOCATION_FILE)
-    
-    # Step 1: If no geolocations file, get geolocations for cities and save to file
-    if not geolocations:
-        geolocations = get_geolocations(cities)
-        save_geolocations_to_file(geolocations, GEOLOCATION_FILE)
-    
-    # Step 2: Filter out invalid geolocations
-    valid_geolocations = filter_valid_geolocations(geolocations)
-    
-    # Step 3: Get weather data for valid geolocations
-    weather_data = get_weather_data(valid_geolocations)
-    
-    # Print results
-    print("Geolocations:")
-    for city, coords in valid_geolocations.items():
+    cities = CITIES
+
+    # Geocode only the cities missing from the geolocations file, skip the ones
+    # that could not be placed, and fetch each forecast right after its city is placed
+    store = geocode_store.GeocodeStore(GEOLOCATION_FILE)
+    for city, coords, data in pipeline.iter_city_forecasts(cities, store, None, iter_city_forecasts):
+        if data is None:
+            continue
         print(f"{city}: {coords}")
-    
-    print("\nWeather Data:")
-    for city, data in weather_data.items():
         print(f"Weather data for {city}:")
         print(data)
         print()
@@ -1,14 +1,35 @@
 # Name:Leila Sarkamari
 # Lab 4 processes-CIS 41B 
-import requests
+import transport
+import scheduler
+import fastjson
+import metrics
+import async_engine
+import batch
+import pools
+import forecast_cache
+import geocode_store
+import weather_log
+import pipeline
+import argparse
 import datetime
 import json
 import os
-import tkinter as tk
-from tkinter import messagebox, filedialog
 import threading
-import multiprocessing
-import time
+import queue
+import lazy_imports
+
+# the GUI toolkit is only loaded once a window is built
+tk = lazy_imports.lazy_module("tkinter")
+messagebox = lazy_imports.lazy_module("tkinter.messagebox")
+filedialog = lazy_imports.lazy_module("tkinter.filedialog")
+ttk = lazy_imports.lazy_module("tkinter.ttk")
+# NumPy is only needed when the results are saved
+export = lazy_imports.lazy_module("export")
+prefetch = lazy_imports.lazy_module("prefetch")
+
+CITIES = ["Napa", "Sonoma", "Santa Cruz", "Monterey", "Berkeley", "Livermore",
+          "San Francisco", "San Mateo", "San Jose", "Los Gatos"]
 
 
 #Global functions for multiprocessing
@@ -20,9 +41,9 @@ def fetch_geolocation(city_name):
     '''
     
 
-    url = f"https://geocoding-api.open-meteo.com/v1/search?name={city_name}&count=10&language=en&format=json"
-    response = requests.get(url)
-    return response.json()
+    url = f"{transport.GEOCODING_URL}?name={city_name}&count=10&language=en&format=json"
+    with metrics.timer("fetch_geolocation"):
+        return scheduler.get_json(url, decode=fastjson.decode_geocode)
 
 def extract_lat_lon(geolocation_data):
     '''
@@ -31,10 +52,11 @@ def extract_lat_lon(geolocation_data):
 
     '''
     
-    for result in geolocation_data.get('results', []):
-        if result['country'] == "United States" and result['admin1'] == "California":
-            return result['latitude'], result['longitude']
-    return None, None
+    with metrics.timer("extract_lat_lon"):
+        for result in geolocation_data.get('results', []):
+            if result['country'] == "United States" and result['admin1'] == "California":
+                return result['latitude'], result['longitude']
+        return None, None
 
 def fetch_geolocation_process(city_name):
     data = fetch_geolocation(city_name)
@@ -43,24 +65,32 @@ def fetch_geolocation_process(city_name):
 def fetch_weather(latitude, longitude):
     start_date = datetime.datetime.now().date()
     end_date = start_date + datetime.timedelta(days=4)
-    url = (f"https://api.open-meteo.com/v1/forecast?"
+    url = (f"{transport.FORECAST_URL}?"
            f"latitude={latitude}&longitude={longitude}&"
            f"daily=temperature_2m_max,temperature_2m_min,windspeed_10m_max,uv_index_max&"
            f"temperature_unit=fahrenheit&wind_speed_unit=mph&timezone=auto&"
            f"start_date={start_date}&end_date={end_date}")
-    response = requests.get(url)
-    return response.json()
+    with metrics.timer("fetch_weather"):
+        return scheduler.get_json(url, decode=fastjson.decode_forecast)
 
-def fetch_weather_process(city, lat, lon, queue):
+def fetch_weather_process(city, lat, lon):
     data = fetch_weather(lat, lon)
-    queue.put((city, data))
+    return [(city, data)]
+
+def fetch_weather_batch_process(chunk):
+    return list(batch.fetch_weather_batch(chunk).items())
 
 # Fetch geolocation data for the cities
+def iter_geolocations_multiprocessing(cities, max_pending=pools.MAX_PENDING, cancel_event=None):
+    '''
+    yield (city, (lat, lon)) as each worker process finishes a lookup.
+    '''
+    jobs = ((city, metrics.collect, (fetch_geolocation_process, city)) for city in cities)
+    for _, collected in pools.iter_completed(pools.get_process_pool(), jobs, max_pending, cancel_event):
+        yield metrics.unwrap(collected)
+
 def get_geolocations_multiprocessing(cities):
-    with multiprocessing.Pool() as pool:
-        results = pool.map(fetch_geolocation_process, cities)
-    geolocations = {city: lat_lon for city, lat_lon in results}
-    return geolocations
+    return dict(iter_geolocations_multiprocessing(cities))
 
 def save_geolocations_to_file(geolocations, filename):
     with open(filename, 'w') as file:
@@ -73,25 +103,45 @@ def load_geolocations_from_file(filename):
     return None
 
 def filter_valid_geolocations(geolocations):
-    return {city: coords for city, coords in geolocations.items() if coords != (None, None)}
+    return {city: coords for city, coords in geolocations.items() if tuple(coords) != (None, None)}
 
 #Fetch weather data for the cities
-def get_weather_data_multiprocessing(valid_geolocations):
-    queue = multiprocessing.Queue()
-    processes = []
-    for city, (lat, lon) in valid_geolocations.items():
-        process = multiprocessing.Process(target=fetch_weather_process, args=(city, lat, lon, queue))
-        processes.append(process)
-        process.start()
-
-    for process in processes:
-        process.join()
-
-    weather_data = {}
-    while not queue.empty():
-        city, data = queue.get()
-        weather_data[city] = data
-    return weather_data
+def iter_weather_data_multiprocessing(locations, batch_size=None, max_pending=pools.MAX_PENDING,
+                                     cancel_event=None):
+    '''
+    yield (city, forecast) for each (city, (lat, lon)) in locations as each
+    worker returns it. Every city (or with batch_size set, every chunk of
+    batch_size cities) is queued on the shared process pool rather than
+    forking a process for it, and results come back through the pool's own
+    result channel, so nothing waits on a process that is still writing.
+    '''
+    if batch_size:
+        jobs = ((index, metrics.collect, (fetch_weather_batch_process, chunk))
+                for index, chunk in enumerate(batch.iter_chunks(locations, batch_size)))
+    else:
+        jobs = ((city, metrics.collect, (fetch_weather_process, city, lat, lon))
+                for city, (lat, lon) in locations)
+    for _, collected in pools.iter_completed(pools.get_process_pool(), jobs, max_pending, cancel_event):
+        yield from metrics.unwrap(collected)
+
+def get_weather_data_multiprocessing(valid_geolocations, batch_size=None):
+    return dict(iter_weather_data_multiprocessing(valid_geolocations.items(), batch_size))
+
+def fetch_city_forecast_process(city, coords=None):
+    if coords is None:
+        coords = extract_lat_lon(fetch_geolocation(city))
+    if tuple(coords) == (None, None):
+        return coords, None
+    return coords, fetch_weather(*coords)
+
+def iter_city_forecasts_multiprocessing(locations, max_pending=pools.MAX_PENDING, cancel_event=None):
+    '''
+    yield (city, (coords, forecast)) for each (city, coords or None) in
+    locations, geocoding and forecasting each city in one worker call.
+    '''
+    jobs = ((city, metrics.collect, (fetch_city_forecast_process, city, coords)) for city, coords in locations)
+    for city, collected in pools.iter_completed(pools.get_process_pool(), jobs, max_pending, cancel_event):
+        yield city, metrics.unwrap(collected)
 
 def save_weather_data_to_file(weather_data, filename):
     with open(filename, 'w') as file:
@@ -110,14 +160,59 @@ class TravelWeatherApp:
 
     '''
      
-    def __init__(self, root):
+    def __init__(self, root, engine="multiprocessing", cache_ttl=3600, cache_radius_km=2, prefetch=True):
         self.WEATHER_DATA_FILE = 'weather_data.json'
+        self.engine = engine
         self.root = root
         self.root.title("Travel Weather App")
         self.selected_cities = []
-        self.weather_data = load_weather_data_from_file(self.WEATHER_DATA_FILE)
+        self.cache_ttl = cache_ttl
+        self.cache_radius_km = cache_radius_km
+        self.prefetch = prefetch
+        self.prefetcher = None
+        self.weather_log = None
+        self.weather_data = {}
+        self.results = queue.Queue()
+        self.jobs = set()
+        self.progress_done = 0
+        self.progress_total = 0
         
         self.setup_main_window()
+        self.root.after_idle(self.load_state)
+        self.root.after(100, self.poll_results)
+
+    def load_state(self):
+        '''
+        open the weather log, the geocode store and the forecast cache. This
+        runs once the main window is up so it shows straight away, or earlier
+        if the user gets to Submit first.
+        '''
+        if self.weather_log is not None:
+            return
+        self.weather_log = weather_log.WeatherLog(legacy_filename=self.WEATHER_DATA_FILE,
+                                               snapshot_filename=weather_log.SNAPSHOT_FILE)
+        self.weather_data = self.weather_log.load()
+        self.geocode_store = geocode_store.GeocodeStore()
+        self.forecast_cache = forecast_cache.ForecastCache(ttl=self.cache_ttl, radius_km=self.cache_radius_km)
+        self.seed_forecast_cache()
+        if self.prefetch:
+            self.start_prefetch()
+
+    def seed_forecast_cache(self):
+        '''
+        forecasts already in the weather log count as fetched when they were
+        saved, so fresh ones are served without a new request.
+        '''
+        self.forecast_cache.seed(self.weather_data, self.geocode_store.geolocations, self.weather_log.saved_at)
+
+    def start_prefetch(self):
+        '''
+        keep the forecasts for the listed cities, and the ones chosen most
+        often, fresh in the cache from a background thread, so Submit is
+        usually answered without waiting on the network.
+        '''
+        self.prefetcher = prefetch.Prefetcher(CITIES, self.geocode_store, self.forecast_cache,
+                                              self.weather_log, geocode=get_geolocations_multiprocessing).start()
 
     def setup_main_window(self):
         '''
@@ -141,13 +236,19 @@ class TravelWeatherApp:
         self.city_listbox = tk.Listbox(self.root, selectmode=tk.MULTIPLE)
         self.city_listbox.pack(padx=5,pady=10)
 
-        cities = ["Napa", "Sonoma", "Santa Cruz", "Monterey", "Berkeley", "Livermore", 
-                  "San Francisco", "San Mateo", "San Jose", "Los Gatos"]
+        cities = CITIES
         for city in cities:
             self.city_listbox.insert(tk.END, city)
 
         tk.Button(self.root, text="Submit", command=self.submit).pack(pady=10)
 
+        self.progress = ttk.Progressbar(self.root, length=200, mode="determinate")
+        self.progress.pack(pady=5)
+        self.status_label = tk.Label(self.root, text="", fg="blue")
+        self.status_label.pack()
+        self.cancel_button = tk.Button(self.root, text="Cancel", command=self.cancel, state=tk.DISABLED)
+        self.cancel_button.pack(pady=5)
+
     def submit(self):
         selected_indices = self.city_listbox.curselection()
         self.selected_cities = [self.city_listbox.get(i) for i in selected_indices]
@@ -156,23 +257,80 @@ class TravelWeatherApp:
             messagebox.showwarning("No Selection", "Please select at least one city.")
             return
 
-        self.fetch_weather_for_selected_cities()
-
-    def fetch_weather_for_selected_cities(self):
-        GEOLOCATION_FILE = 'geolocations.json'
-        geolocations = load_geolocations_from_file(GEOLOCATION_FILE)
-        if not geolocations:
-            geolocations = get_geolocations_multiprocessing(self.selected_cities)
-            save_geolocations_to_file(geolocations, GEOLOCATION_FILE)
-        
-        valid_geolocations = filter_valid_geolocations(geolocations)
-        weather_data = get_weather_data_multiprocessing(valid_geolocations)
-        self.weather_data.update(weather_data)
-        save_weather_data_to_file(self.weather_data,self.WEATHER_DATA_FILE)
-
         self.city_listbox.selection_clear(0, tk.END)
-        for city in self.selected_cities:
-            self.show_weather_display(city, self.weather_data[city])
+        self.load_state()
+        if self.prefetcher is not None:
+            self.prefetcher.record(self.selected_cities)
+        cancel_event = threading.Event()
+        self.jobs.add(cancel_event)
+        self.progress_total += len(self.selected_cities)
+        self.update_progress()
+        thread = threading.Thread(target=self.fetch_weather_for_selected_cities,
+                                  args=(list(self.selected_cities), cancel_event), daemon=True)
+        thread.start()
+
+    def cancel(self):
+        for cancel_event in self.jobs:
+            cancel_event.set()
+
+    def fetch_weather_for_selected_cities(self, cities, cancel_event):
+        '''
+        runs on a background thread so the window stays responsive. Each city
+        is forecast as soon as its own geocode is known and handed to the Tk
+        thread through self.results the moment it is ready, whether it came
+        from the caches or the network.
+        '''
+        try:
+            for city, coords, data in pipeline.iter_city_forecasts(
+                    cities, self.geocode_store, self.forecast_cache, self.chain_function(), cancel_event):
+                if data is None:
+                    self.results.put(("skipped", city, None))
+                    continue
+                self.weather_log.append({city: data})
+                self.results.put(("city", city, data))
+        except Exception as error:
+            self.results.put(("error", None, str(error)))
+        finally:
+            self.results.put(("done", cancel_event, None))
+
+    def chain_function(self):
+        if self.engine == "asyncio":
+            return async_engine.iter_city_forecasts_async
+        return iter_city_forecasts_multiprocessing
+
+    def poll_results(self):
+        '''
+        drain self.results on the Tk thread and open a display window for
+        each city that has arrived. Reschedules itself with after().
+        '''
+        while True:
+            try:
+                kind, key, value = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "city":
+                self.progress_done += 1
+                self.show_weather_display(key, value)
+            elif kind == "skipped":
+                self.progress_done += 1
+            elif kind == "error":
+                messagebox.showerror("Error", value)
+            elif kind == "done":
+                self.jobs.discard(key)
+                if not self.jobs:
+                    self.progress_done = self.progress_total = 0
+            self.update_progress()
+        self.root.after(100, self.poll_results)
+
+    def update_progress(self):
+        self.progress["maximum"] = max(self.progress_total, 1)
+        self.progress["value"] = self.progress_done
+        if self.jobs:
+            self.status_label.config(text=f"Fetched {self.progress_done} of {self.progress_total}")
+            self.cancel_button.config(state=tk.NORMAL)
+        else:
+            self.status_label.config(text="")
+            self.cancel_button.config(state=tk.DISABLED)
 
     def show_weather_display(self, city, data):
         '''
@@ -214,88 +372,36 @@ class TravelWeatherApp:
                 listbox.insert(tk.END, item)
 
     def on_close(self):
+        self.load_state()
+        if self.prefetcher is not None:
+            self.prefetcher.stop(timeout=1)
         if messagebox.askokcancel("Quit", "Do you want to save your search results?"):
             directory = filedialog.askdirectory()
             if directory:
-                with open(os.path.join(directory, "weather.txt"), 'w') as file:
-                    for city, data in self.weather_data.items():
-                        file.write(f"{city}:\n")
-                        file.write(",".join(data['daily']['time']) + "\n")
-                        file.write(",".join(map(str, data['daily']['temperature_2m_max'])) + "\n")
-                        file.write(",".join(map(str, data['daily']['temperature_2m_min'])) + "\n")
-                        file.write(",".join(map(str, data['daily']['windspeed_10m_max'])) + "\n")
-                        file.write(",".join(map(str, data['daily']['uv_index_max'])) + "\n\n")
+                export.export(self.weather_data, os.path.join(directory, "weather.txt"), "txt")
                 messagebox.showinfo("Saved", f"Weather data saved to {directory}/weather.txt")
         self.root.destroy()
 
 if __name__ == "__main__":
-    cities = ["Napa", "Sonoma", "Santa Cruz", "Monterey", "Berkeley", "Livermore", 
-              "San Francisco", "San Mateo", "San Jose", "Los Gatos"]
-
-    # Measure elapsed time for serial geolocation fetching
-    start_time = time.time()
-    geolocations_serial = get_geolocations_multiprocessing(cities)
-    end_time = time.time()
-    serial_geolocation_time = end_time - start_time
-
-    # Measure elapsed time for threaded geolocation fetching
-    start_time = time.time()
-    geolocations_threaded = get_geolocations_multiprocessing(cities)
-    end_time = time.time()
-    threaded_geolocation_time = end_time - start_time
-
-    # Measure elapsed time for multiprocessing geolocation fetching
-    start_time = time.time()
-    geolocations_multiprocessing = get_geolocations_multiprocessing(cities)
-    end_time = time.time()
-    multiprocessing_geolocation_time = end_time - start_time
-
-    valid_geolocations = filter_valid_geolocations(geolocations_threaded)
-
-    # Measure elapsed time for serial weather fetching
-    start_time = time.time()
-    weather_data_serial = get_weather_data_multiprocessing(valid_geolocations)
-    end_time = time.time()
-    serial_weather_time = end_time - start_time
-
-    # Measure elapsed time for threaded weather fetching
-    start_time = time.time()
-    weather_data_threaded = get_weather_data_multiprocessing(valid_geolocations)
-    end_time = time.time()
-    threaded_weather_time = end_time - start_time
-
-    # Measure elapsed time for multiprocessing weather fetching
-    start_time = time.time()
-    weather_data_multiprocessing = get_weather_data_multiprocessing(valid_geolocations)
-    end_time = time.time()
-    multiprocessing_weather_time = end_time - start_time
-
-    # Print the elapsed times
-    print(f"{'':<20}{'serial':<20}{'multithreading':<20}{'multiprocessing':<20}")
-    print(f"{'geocoding data':<20}{serial_geolocation_time:<20.2f}{threaded_geolocation_time:<20.2f}{multiprocessing_geolocation_time:<20.2f}")
-    print(f"{'weather data':<20}{serial_weather_time:<20.2f}{threaded_weather_time:<20.2f}{multiprocessing_weather_time:<20.2f}")
-  
+    parser = argparse.ArgumentParser(description="Look up the 5-day weather at Bay Area destinations.")
+    parser.add_argument("--benchmark", action="store_true",
+                        help="time the fetch modes against a local stub API before opening the window")
+    parser.add_argument("--first-window", action="store_true",
+                        help="exit as soon as the main window is drawn (used by benchmark.py --startup)")
+    parser.add_argument("--no-prefetch", action="store_true",
+                        help="only fetch forecasts when Submit is clicked")
+    args = parser.parse_args()
+    if args.benchmark:
+        # Serial vs concurrent timings against a local stub API (see benchmark.py for the full suite)
+        import benchmark
+        benchmark.print_table(benchmark.run(modes=("serial", "threaded", "process", "asyncio"), sizes=(10,), repeats=3))
+
     root = tk.Tk()
-    app = TravelWeatherApp(root)
+    app = TravelWeatherApp(root, prefetch=not args.no_prefetch)
     root.protocol("WM_DELETE_WINDOW", app.on_close)
-    root.mainloop()
-'''
-output:
-                    serial              multithreading      multiprocessing     
-geocoding data      1.46                1.03                0.83                
-weather data        0.94                0.91                0.89               
-
-The ranking from slowest to fastest is:
-
-1)Serial
-2)Multiprocessing
-3)Multithreading
-
-In the serial approach, each API request is made one after the other and should waits for the previous one to complete.
-In the multithreading approach,threads run concurrently and initiate multiple requests simultaneously.
-Threads allow concurrent execution of tasks within the same process.
-threading can improve performance significantly, but not as much as multiprocessing since threads share the same memory space
-In the multiprocessing approach, multiple processes are created to handle API requests concurrently.
-Each process runs in its own memory space and has its own Python interpreter, which allows true parallelism, so it is the fastest approche here
-
-'''
\ No newline at end of file
+    if args.first_window:
+        root.update()
+        print("first window", flush=True)
+        root.destroy()
+    else:
+        root.mainloop()
@@ -0,0 +1,43 @@
+# Deferred imports: a module is only loaded the first time one of its attributes is used
+import importlib
+import importlib.util
+import sys
+import threading
+import types
+
+_lock = threading.Lock()
+
+
+class _LazyModule(types.ModuleType):
+    '''
+    stands in for a module until an attribute is looked up on it, then
+    imports the real one and forwards to it from then on.
+    '''
+    def __getattr__(self, attribute):
+        module = self.__dict__.get("_module")
+        if module is None:
+            with _lock:
+                module = self.__dict__.get("_module")
+                if module is None:
+                    module = importlib.import_module(self.__name__)
+                    self.__dict__["_module"] = module
+        return getattr(module, attribute)
+
+
+def lazy_module(name):
+    '''
+    the module called name, imported on first use instead of now. Works for
+    submodules such as "tkinter.messagebox" without importing the parent.
+    A module that is already loaded is returned as it is.
+    '''
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return _LazyModule(name)
+
+
+def module_available(name):
+    '''
+    whether a top-level module can be imported, without importing it.
+    '''
+    return importlib.util.find_spec(name) is not None
@@ -0,0 +1,236 @@
+# Per-stage timers, counters and gauges for the fetch pipeline
+import atexit
+import contextlib
+import json
+import os
+import threading
+import time
+import lazy_imports
+
+# only needed once serve() is called
+http_server = lazy_imports.lazy_module("http.server")
+
+# set WEATHER_METRICS=1 to turn collection on; worker processes inherit it
+ENABLED = os.environ.get("WEATHER_METRICS", "") not in ("", "0")
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def gauge_add(self, name, delta):
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + delta
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = {"buckets": [0] * (len(BUCKETS) + 1), "sum": 0.0, "count": 0}
+            index = 0
+            while index < len(BUCKETS) and seconds > BUCKETS[index]:
+                index += 1
+            histogram["buckets"][index] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {stage: {"buckets": list(h["buckets"]), "sum": h["sum"], "count": h["count"]}
+                               for stage, h in self.histograms.items()},
+            }
+
+    def drain(self):
+        with self.lock:
+            snapshot = {"counters": self.counters, "gauges": {}, "histograms": self.histograms}
+            self.counters = {}
+            self.histograms = {}
+            return snapshot
+
+    def merge(self, snapshot):
+        '''
+        add the counts drained from a worker process into this registry.
+        '''
+        with self.lock:
+            for name, value in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for stage, other in snapshot["histograms"].items():
+                histogram = self.histograms.setdefault(
+                    stage, {"buckets": [0] * (len(BUCKETS) + 1), "sum": 0.0, "count": 0})
+                histogram["buckets"] = [a + b for a, b in zip(histogram["buckets"], other["buckets"])]
+                histogram["sum"] += other["sum"]
+                histogram["count"] += other["count"]
+
+
+registry = Registry()
+sinks = []
+
+
+class _Timer:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        registry.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class _InFlight:
+    __slots__ = ("name",)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        registry.gauge_add(self.name, 1)
+        return self
+
+    def __exit__(self, *exc_info):
+        registry.gauge_add(self.name, -1)
+        return False
+
+
+def timer(stage):
+    '''
+    with metrics.timer("fetch_weather"): ... records how long the block took.
+    Returns a shared do-nothing context when metrics are off.
+    '''
+    return _Timer(stage) if ENABLED else _NULL_CONTEXT
+
+
+def in_flight(name):
+    return _InFlight(name) if ENABLED else _NULL_CONTEXT
+
+
+def increment(name, amount=1):
+    if ENABLED:
+        registry.increment(name, amount)
+
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+    os.environ["WEATHER_METRICS"] = "1" if enabled else "0"
+
+
+def collect(function, *args):
+    '''
+    run function in a worker process and return its result together with the
+    metrics it recorded, for the parent to pass to unwrap().
+    '''
+    result = function(*args)
+    return result, registry.drain() if ENABLED else None
+
+
+def unwrap(collected):
+    result, snapshot = collected
+    if snapshot is not None:
+        registry.merge(snapshot)
+    return result
+
+
+def to_json(snapshot=None):
+    snapshot = snapshot or registry.snapshot()
+    snapshot = dict(snapshot, buckets=list(BUCKETS))
+    return json.dumps(snapshot, indent=2)
+
+
+def to_prometheus(snapshot=None):
+    snapshot = snapshot or registry.snapshot()
+    lines = ["# TYPE weather_events_total counter"]
+    for name, value in sorted(snapshot["counters"].items()):
+        lines.append(f'weather_events_total{{event="{name}"}} {value}')
+    lines.append("# TYPE weather_in_flight gauge")
+    for name, value in sorted(snapshot["gauges"].items()):
+        lines.append(f'weather_in_flight{{name="{name}"}} {value}')
+    lines.append("# TYPE weather_stage_seconds histogram")
+    for stage, histogram in sorted(snapshot["histograms"].items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), histogram["buckets"]):
+            cumulative += count
+            lines.append(f'weather_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'weather_stage_seconds_sum{{stage="{stage}"}} {histogram["sum"]}')
+        lines.append(f'weather_stage_seconds_count{{stage="{stage}"}} {histogram["count"]}')
+    return "\n".join(lines) + "\n"
+
+
+class FileSink:
+    '''
+    writes the metrics to path on every flush(), as Prometheus text or JSON
+    depending on format.
+    '''
+    def __init__(self, path, format="prometheus"):
+        self.path = path
+        self.format = format
+
+    def __call__(self, snapshot):
+        text = to_prometheus(snapshot) if self.format == "prometheus" else to_json(snapshot)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as file:
+            file.write(text)
+        os.replace(temp_path, self.path)
+
+
+def add_sink(sink):
+    sinks.append(sink)
+
+
+def flush():
+    if not sinks:
+        return
+    snapshot = registry.snapshot()
+    for sink in sinks:
+        sink(snapshot)
+
+
+def _metrics_handler():
+    class MetricsHandler(http_server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/metrics.json"):
+                body, content_type = to_json().encode(), "application/json"
+            else:
+                body, content_type = to_prometheus().encode(), "text/plain; version=0.0.4"
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsHandler
+
+
+def serve(port=9464, host="127.0.0.1"):
+    '''
+    expose /metrics (Prometheus text) and /metrics.json on a background thread.
+    '''
+    server = http_server.ThreadingHTTPServer((host, port), _metrics_handler())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+atexit.register(flush)
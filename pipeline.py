@@ -0,0 +1,48 @@
+# Pipelined geocode-to-forecast: each city's forecast starts as soon as its own geocode is known
+import transport
+import metrics
+
+
+def iter_city_forecasts(cities, store, cache, iter_chains, cancel_event=None):
+    '''
+    yield (city, (lat, lon), forecast) for each city as soon as its own
+    chain is done, instead of geocoding every city before forecasting any.
+    Cities with known coordinates in store and a fresh entry in cache are
+    yielded straight away. The rest go to iter_chains (one of the
+    iter_city_forecasts_* functions), which geocodes a city if needed and
+    then fetches its forecast in the same job, so no forecast waits on
+    another city's geocode. forecast is None for cities the geocoder could
+    not place; cities whose chain failed are left out. store and cache may
+    be None to skip them, and both are saved once the stream is exhausted.
+    '''
+    start_date, end_date = transport.forecast_window()
+    chains = []
+    for city in cities:
+        coords = store.lookup(city) if store is not None else None
+        if coords is None:
+            metrics.increment("geocode_cache_miss")
+            chains.append((city, None))
+            continue
+        metrics.increment("geocode_cache_hit")
+        if tuple(coords) == (None, None):
+            yield city, coords, None
+            continue
+        data = cache.get(coords[0], coords[1], start_date, end_date) if cache is not None else None
+        if data is not None:
+            yield city, coords, data
+        else:
+            chains.append((city, coords))
+
+    geocoded = fetched = False
+    for city, (coords, data) in iter_chains(chains, cancel_event=cancel_event):
+        if store is not None and store.lookup(city) is None:
+            store.add(city, coords)
+            geocoded = True
+        if data is not None and cache is not None:
+            cache.put(coords[0], coords[1], start_date, end_date, data)
+            fetched = True
+        yield city, coords, data
+    if geocoded:
+        store.save()
+    if fetched:
+        cache.save()
@@ -0,0 +1,131 @@
+# Long-lived worker pools shared by every fetch in a run
+import atexit
+import concurrent.futures
+import threading
+import metrics
+import scheduler
+import transport
+
+THREAD_WORKERS = 16
+# the work is waiting on the network, so the process count is not tied to CPUs
+PROCESS_WORKERS = 8
+# jobs handed to a pool at once by iter_completed(); more are only read from
+# the input as earlier ones are consumed
+MAX_PENDING = 64
+# share of each host's rate limit the parent keeps for its own requests (the
+# prefetcher's refreshes) while a process pool fetches with the rest
+PARENT_RATE_SHARE = 0.2
+
+_thread_pool = None
+_process_pool = None
+_lock = threading.Lock()
+
+
+def configure_pools(thread_workers=None, process_workers=None):
+    '''
+    change the pool sizes. Pools that already exist are shut down and the
+    next call builds them again with the new size.
+    '''
+    global THREAD_WORKERS, PROCESS_WORKERS
+    if thread_workers is not None:
+        THREAD_WORKERS = thread_workers
+    if process_workers is not None:
+        PROCESS_WORKERS = process_workers
+    shutdown_pools()
+
+
+def get_thread_pool():
+    '''
+    the thread pool is created on first use and reused afterwards. Work
+    submitted beyond THREAD_WORKERS waits in the executor's queue instead of
+    starting more threads.
+    '''
+    global _thread_pool
+    with _lock:
+        if _thread_pool is None:
+            _thread_pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=THREAD_WORKERS, thread_name_prefix="weather-fetch")
+        return _thread_pool
+
+
+def get_process_pool():
+    '''
+    the process pool is created on first use and reused afterwards. While
+    it exists the parent is limited to PARENT_RATE_SHARE of each host's
+    quota and the workers split the rest, so the parent's own requests and
+    the workers' together stay within the limit.
+    '''
+    global _process_pool
+    with _lock:
+        if _process_pool is None:
+            scheduler.set_rate_share(PARENT_RATE_SHARE)
+            _process_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=PROCESS_WORKERS, initializer=_init_worker,
+                initargs=(transport.GEOCODING_URL, transport.FORECAST_URL,
+                          (1 - PARENT_RATE_SHARE) / PROCESS_WORKERS))
+        return _process_pool
+
+
+def _init_worker(geocoding_url, forecast_url, rate_share):
+    '''
+    workers start with the parent's endpoints even when they are spawned
+    rather than forked, and each takes an equal share of what the parent
+    leaves of the rate limit. A forked worker also inherits the parent's
+    metrics, which are cleared so that collect() only sends back what the
+    worker recorded itself.
+    '''
+    metrics.registry.reset()
+    transport.set_endpoints(geocoding_url, forecast_url)
+    scheduler.set_rate_share(rate_share)
+
+
+def iter_completed(executor, jobs, max_pending=MAX_PENDING, cancel_event=None):
+    '''
+    submit (key, function, args) jobs to executor and yield (key, result) in
+    the order they finish. At most max_pending jobs are queued at a time and
+    the next one is only taken from jobs after a result has been consumed, so
+    a slow consumer holds the input back instead of piling up results. Jobs
+    that raise are left out. Closing the generator early, or setting
+    cancel_event (a threading.Event), cancels whatever has not started.
+    '''
+    jobs = iter(jobs)
+    pending = {}
+    timeout = None if cancel_event is None else 0.1
+
+    def fill():
+        for key, function, args in jobs:
+            pending[executor.submit(function, *args)] = key
+            if len(pending) >= max_pending:
+                return
+
+    try:
+        fill()
+        while pending:
+            done, _ = concurrent.futures.wait(pending, timeout=timeout,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            for future in done:
+                key = pending.pop(future)
+                if future.exception() is None:
+                    yield key, future.result()
+            fill()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def shutdown_pools(wait=True):
+    global _thread_pool, _process_pool
+    with _lock:
+        thread_pool, process_pool = _thread_pool, _process_pool
+        _thread_pool = _process_pool = None
+    if thread_pool is not None:
+        thread_pool.shutdown(wait=wait, cancel_futures=True)
+    if process_pool is not None:
+        process_pool.shutdown(wait=wait, cancel_futures=True)
+        # the parent has the whole quota again
+        scheduler.set_rate_share(1.0)
+
+
+atexit.register(shutdown_pools)
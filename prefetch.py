@@ -0,0 +1,180 @@
+# Background prefetch: keeps the forecast cache warm for the cities users ask for
+import collections
+import datetime
+import json
+import os
+import random
+import threading
+import time
+import metrics
+import refresh
+import transport
+
+REQUEST_COUNTS_FILE = 'city_requests.json'
+# the global models behind the forecast API are run four times a day (UTC)
+# and their output is available a few hours after the run starts
+MODEL_RUN_HOURS = (0, 6, 12, 18)
+MODEL_RUN_DELAY = 3 * 3600
+# a scheduled refresh starts up to JITTER seconds late and is spread over
+# SPREAD seconds, so clients sharing a schedule do not all hit the API at once
+JITTER = 300
+SPREAD = 120
+CHUNK_SIZE = 5
+# refresh entries before the cache would treat them as missing
+REFRESH_BEFORE_EXPIRY = 0.8
+POPULAR_CITIES = 10
+MAX_PENDING = 4
+
+
+class RequestCounts:
+    '''
+    how often each city has been asked for, kept in a small JSON file so the
+    most requested cities can be prefetched on the next start as well.
+    '''
+    def __init__(self, filename=REQUEST_COUNTS_FILE):
+        self.filename = filename
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        if os.path.exists(filename):
+            with open(filename, 'r') as file:
+                self.counts.update(json.load(file))
+
+    def record(self, cities):
+        with self.lock:
+            self.counts.update(cities)
+
+    def most_common(self, n):
+        with self.lock:
+            return [city for city, _ in self.counts.most_common(n)]
+
+    def save(self):
+        with self.lock:
+            counts = dict(self.counts)
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, 'w') as file:
+            json.dump(counts, file)
+        os.replace(temp_filename, self.filename)
+
+
+def next_model_update(now=None, hours=MODEL_RUN_HOURS, delay=MODEL_RUN_DELAY):
+    '''
+    the first time after now (epoch seconds) at which a model run's output
+    should be available.
+    '''
+    now = time.time() if now is None else now
+    day = datetime.datetime.fromtimestamp(now, datetime.timezone.utc).replace(hour=0, minute=0, second=0,
+                                                                              microsecond=0)
+    for days in (-1, 0, 1):
+        for hour in hours:
+            update = (day + datetime.timedelta(days=days, hours=hour)).timestamp() + delay
+            if update > now:
+                return update
+    return now + 86400
+
+
+class Prefetcher:
+    '''
+    refreshes the forecasts of a fixed city list plus the most requested
+    cities on a daemon thread. On start it fetches whatever is missing or
+    stale in the cache, then it wakes after each model update (or before
+    cache entries would expire, if that is sooner) and refreshes them all
+    with conditional requests, a few cities at a time. geocode is a
+    {city: (lat, lon)} lookup for cities the geocode store has not seen.
+    '''
+    def __init__(self, cities, store, cache, log=None, geocode=None, counts=None,
+                 popular=POPULAR_CITIES, jitter=JITTER, spread=SPREAD):
+        self.cities = list(cities)
+        self.store = store
+        self.cache = cache
+        self.log = log
+        self.geocode = geocode
+        self.counts = counts if counts is not None else RequestCounts()
+        self.popular = popular
+        self.jitter = jitter
+        self.spread = spread
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def record(self, cities):
+        '''
+        count a user request for cities, so popular ones are prefetched too.
+        '''
+        self.counts.record(cities)
+
+    def wanted(self):
+        cities = list(self.cities)
+        cities += [city for city in self.counts.most_common(self.popular) if city not in cities]
+        return cities
+
+    def locations(self, cities):
+        if self.geocode is not None:
+            geolocations = self.store.resolve(cities, self.geocode)
+        else:
+            geolocations = {city: self.store.lookup(city) for city in cities}
+        return {city: coords for city, coords in geolocations.items() if coords and coords[0] is not None}
+
+    def stale(self, locations):
+        '''
+        the locations without a cache entry that is still fresh for
+        REFRESH_BEFORE_EXPIRY of the ttl.
+        '''
+        start_date, end_date = transport.forecast_window()
+        now = time.time()
+        stale = {}
+        for city, (lat, lon) in locations.items():
+            entry = self.cache.entry(lat, lon, start_date, end_date)
+            if entry is None or now - entry["fetched_at"] > self.cache.ttl * REFRESH_BEFORE_EXPIRY:
+                stale[city] = (lat, lon)
+        return stale
+
+    def warm(self, only_stale=False, spread=0):
+        '''
+        refresh the wanted cities, CHUNK_SIZE at a time with the chunks spaced
+        over spread seconds. The cache file is saved once at the end if any
+        entry was updated. Returns the summed refresh counts.
+        '''
+        locations = self.locations(self.wanted())
+        if only_stale:
+            locations = self.stale(locations)
+        items = list(locations.items())
+        chunks = [dict(items[i:i + CHUNK_SIZE]) for i in range(0, len(items), CHUNK_SIZE)]
+        totals = collections.Counter()
+        try:
+            for i, chunk in enumerate(chunks):
+                if i and spread and self.stop_event.wait(spread / len(chunks)):
+                    break
+                with metrics.timer("prefetch"):
+                    totals.update(refresh.refresh_locations(chunk, self.cache, self.log, MAX_PENDING, save=False))
+        finally:
+            if sum(totals.values()) > totals["failed"]:
+                self.cache.save()
+        return totals
+
+    def next_delay(self, now=None):
+        now = time.time() if now is None else now
+        update = next_model_update(now) + random.uniform(0, self.jitter)
+        return max(0.0, min(update, now + self.cache.ttl * REFRESH_BEFORE_EXPIRY) - now)
+
+    def run(self):
+        only_stale, spread = True, 0
+        while not self.stop_event.is_set():
+            try:
+                self.warm(only_stale, spread)
+            except Exception:
+                # a failed round is retried on the next schedule
+                metrics.increment("prefetch_error")
+            only_stale, spread = False, self.spread
+            if self.stop_event.wait(self.next_delay()):
+                break
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="prefetch", daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.counts.save()
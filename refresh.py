@@ -0,0 +1,130 @@
+# Delta refresh: conditional forecast requests that only rewrite what changed
+import argparse
+import sys
+import time
+import fastjson
+import forecast_cache
+import geocode_store
+import lab4
+import metrics
+import pools
+import scheduler
+import transport
+import weather_log
+
+# response headers worth keeping with a cached forecast
+META_HEADERS = {"ETag": "etag", "Last-Modified": "last_modified", "Date": "date"}
+
+
+def conditional_headers(meta):
+    '''
+    If-None-Match / If-Modified-Since for a forecast fetched before, from
+    the meta stored with its cache entry.
+    '''
+    headers = {}
+    if meta and meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta and meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+
+def fetch_forecast_conditional(latitude, longitude, start_date, end_date, meta=None):
+    '''
+    fetch a forecast, sending the validators from meta. Returns (None, meta)
+    when the server answers 304 Not Modified, otherwise (forecast, new meta)
+    with the forecast cut down as fastjson.decode_forecast does and the
+    model-run details (generationtime_ms, timezone, validators) in meta.
+    '''
+    url = transport.forecast_url(latitude, longitude, start_date, end_date)
+    with metrics.timer("fetch_weather"):
+        response = scheduler.get_scheduler().get(url, headers=conditional_headers(meta))
+    now = time.time()
+    if response.status_code == 304:
+        metrics.increment("refresh_not_modified")
+        meta = dict(meta or {}, checked_at=now)
+        # a 304 may carry fresher validators
+        meta.update({key: response.headers[header] for header, key in META_HEADERS.items()
+                     if header in response.headers})
+        return None, meta
+    data = scheduler.decode_body(response.content)
+    new_meta = {key: response.headers[header] for header, key in META_HEADERS.items()
+                if header in response.headers}
+    new_meta.update(generationtime_ms=data.get("generationtime_ms"), timezone=data.get("timezone"),
+                    checked_at=now)
+    return fastjson.compact_forecast(data), new_meta
+
+
+def refresh_locations(locations, cache, log=None, max_pending=pools.MAX_PENDING, save=True):
+    '''
+    refresh {city: (lat, lon)} against the API whatever the cache ttl says.
+    A city whose forecast is not modified, or comes back with the same daily
+    values, only has its cache entry's time and meta updated; the others are
+    stored in the cache and appended to log. With save set, the cache file
+    is rewritten once at the end, and only if an entry was updated; callers
+    refreshing in several steps can pass save=False and save once
+    themselves. Returns counts for "not_modified", "unchanged", "changed"
+    and "failed".
+    '''
+    start_date, end_date = transport.forecast_window()
+    entries = {city: cache.entry(lat, lon, start_date, end_date) for city, (lat, lon) in locations.items()}
+    jobs = ((city, fetch_forecast_conditional, (lat, lon, start_date, end_date, (entries[city] or {}).get("meta")))
+            for city, (lat, lon) in locations.items())
+    counts = dict.fromkeys(("not_modified", "unchanged", "changed", "failed"), 0)
+    changed = {}
+    for city, (data, meta) in pools.iter_completed(pools.get_thread_pool(), jobs, max_pending):
+        lat, lon = locations[city]
+        entry = entries[city]
+        if data is None:
+            if cache.touch(lat, lon, start_date, end_date, meta):
+                counts["not_modified"] += 1
+                continue
+            # the entry was evicted while the request was in flight
+            try:
+                data, meta = fetch_forecast_conditional(lat, lon, start_date, end_date)
+            except Exception:
+                # counted as failed below
+                continue
+        stored = entry["data"] if entry is not None else None
+        if stored is None and log is not None:
+            stored = log.index.get(city)
+        if stored is not None and stored.get("daily") == data.get("daily"):
+            metrics.increment("refresh_unchanged")
+            counts["unchanged"] += 1
+            if not cache.touch(lat, lon, start_date, end_date, meta):
+                cache.put(lat, lon, start_date, end_date, stored, meta=meta)
+            continue
+        metrics.increment("refresh_changed")
+        counts["changed"] += 1
+        cache.put(lat, lon, start_date, end_date, data, meta=meta)
+        changed[city] = data
+    counts["failed"] = len(locations) - sum(counts.values())
+    if log is not None and changed:
+        log.append(changed)
+    if save and counts["failed"] < len(locations):
+        cache.save()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Refresh stored forecasts, rewriting only the cities whose forecast changed.")
+    parser.add_argument("cities", nargs="*", help="cities to refresh; by default every city in the geocode store")
+    parser.add_argument("--geolocations", default=geocode_store.GEOLOCATION_FILE)
+    parser.add_argument("--weather-log", default=weather_log.WEATHER_LOG_FILE)
+    parser.add_argument("--concurrency", type=int, default=pools.THREAD_WORKERS)
+    args = parser.parse_args(argv)
+
+    pools.configure_pools(thread_workers=args.concurrency)
+    store = geocode_store.GeocodeStore(args.geolocations)
+    cities = args.cities or list(store.geolocations)
+    locations = lab4.filter_valid_geolocations(store.resolve(cities, lab4.get_geolocations))
+    log = weather_log.WeatherLog(args.weather_log, legacy_filename=None)
+    log.load()
+    counts = refresh_locations(locations, forecast_cache.ForecastCache(), log)
+    print(", ".join(f"{count} {name.replace('_', ' ')}" for name, count in counts.items()), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
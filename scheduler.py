@@ -0,0 +1,244 @@
+# Rate-limited request scheduler with retries, backoff and Retry-After support
+import random
+import threading
+import time
+from urllib.parse import urlparse
+import transport
+import metrics
+import fastjson
+import lazy_imports
+
+asyncio = lazy_imports.lazy_module("asyncio")
+email_utils = lazy_imports.lazy_module("email.utils")
+requests = lazy_imports.lazy_module("requests")
+
+# requests per second and burst size for each API host; other hosts are not limited
+RATE_LIMITS = {
+    "geocoding-api.open-meteo.com": (8.0, 10),
+    "api.open-meteo.com": (8.0, 10),
+}
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+# longest Retry-After that is waited out rather than treated as a failure
+MAX_RETRY_AFTER = BACKOFF_CAP
+TIMEOUT = 10
+
+_rate_share = 1.0
+
+
+class TokenBucket:
+    '''
+    rate tokens per second up to burst. reserve() takes a token and returns
+    how long the caller has to wait before using it, so threads and
+    coroutines can each sleep in their own way.
+    '''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+            return max(wait, self.paused_until - now)
+
+    def pause(self, seconds):
+        '''
+        hold every request to this host back for seconds, as asked by a
+        Retry-After header.
+        '''
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RetryBudget:
+    '''
+    retries are paid for out of a budget that each first attempt tops up by
+    ratio, so when the API is failing hard the retries stop instead of
+    multiplying the load on it.
+    '''
+    def __init__(self, ratio=0.2, max_tokens=10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class RequestScheduler:
+    def __init__(self, rate_limits=None, max_retries=MAX_RETRIES, retry_budget=None):
+        self.rate_limits = RATE_LIMITS if rate_limits is None else rate_limits
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget or RetryBudget()
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.retries = 0
+
+    def bucket(self, url):
+        host = urlparse(url).hostname
+        if host not in self.rate_limits:
+            return None
+        with self.lock:
+            if host not in self.buckets:
+                rate, burst = self.rate_limits[host]
+                self.buckets[host] = TokenBucket(rate * _rate_share, max(1, int(burst * _rate_share)))
+            return self.buckets[host]
+
+    def delay_before(self, url):
+        bucket = self.bucket(url)
+        return bucket.reserve() if bucket is not None else 0.0
+
+    def retry_delay(self, url, attempt, status=None, retry_after=None):
+        '''
+        seconds to wait before attempt number attempt + 1, or None when the
+        request should not be retried. A Retry-After longer than
+        MAX_RETRY_AFTER is not waited out: the request fails straight away so
+        its city is skipped instead of holding a worker (and the host's
+        bucket) for that long.
+        '''
+        if status is not None and status not in RETRY_STATUSES:
+            return None
+        delay = parse_retry_after(retry_after)
+        if delay is not None and delay > MAX_RETRY_AFTER:
+            metrics.increment("retry_after_too_long")
+            return None
+        if attempt >= self.max_retries or not self.retry_budget.withdraw():
+            return None
+        with self.lock:
+            self.retries += 1
+        metrics.increment("retries")
+        if delay is not None:
+            bucket = self.bucket(url)
+            if bucket is not None:
+                bucket.pause(delay)
+            return delay
+        return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+    def get(self, url, timeout=TIMEOUT, headers=None):
+        '''
+        GET url through the host's rate limit, retrying 429s, 5xx responses,
+        timeouts and connection errors. Raises requests.HTTPError or the
+        last connection error once the retries or the budget run out.
+        headers are sent with the request, e.g. for a conditional GET; a
+        304 Not Modified is returned like any other successful response.
+        '''
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            time.sleep(self.delay_before(url))
+            try:
+                with metrics.in_flight("http_requests"), metrics.timer("http_request"):
+                    response = transport.get_session().get(url, timeout=timeout, headers=headers)
+            except (requests.ConnectionError, requests.Timeout):
+                delay = self.retry_delay(url, attempt)
+                if delay is None:
+                    raise
+            else:
+                if response.ok:
+                    return response
+                delay = self.retry_delay(url, attempt, response.status_code, response.headers.get("Retry-After"))
+                if delay is None:
+                    response.raise_for_status()
+            time.sleep(delay)
+            attempt += 1
+
+    async def get_json_async(self, session, url, timeout=TIMEOUT, decode=None):
+        '''
+        the same policy for an aiohttp session, sleeping with asyncio. The body
+        is decoded as in get_json().
+        '''
+        import aiohttp
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.delay_before(url))
+            try:
+                with metrics.in_flight("http_requests"), metrics.timer("http_request"):
+                    async with session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                        body = await response.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                delay = self.retry_delay(url, attempt)
+                if delay is None:
+                    raise
+            else:
+                if response.ok:
+                    return decode_body(body, decode)
+                delay = self.retry_delay(url, attempt, response.status, response.headers.get("Retry-After"))
+                if delay is None:
+                    response.raise_for_status()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email_utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
+
+
+def set_rate_share(share):
+    '''
+    give this process share of each host's quota. Worker processes call this
+    so that all of them together stay within the limit.
+    '''
+    global _rate_share, _scheduler
+    _rate_share = share
+    with _scheduler_lock:
+        _scheduler = None
+
+
+def get_json(url, timeout=TIMEOUT, decode=None):
+    '''
+    GET url and decode its body with decode (e.g. fastjson.decode_forecast,
+    which keeps only the fields the app reads), or in full with
+    fastjson.loads when decode is None.
+    '''
+    response = get_scheduler().get(url, timeout)
+    return decode_body(response.content, decode)
+
+
+def decode_body(body, decode=None):
+    with metrics.timer("json_decode"):
+        try:
+            return (decode or fastjson.loads)(body)
+        except fastjson.DecodeError as error:
+            # a bad body counts as a failed request, as response.json() did
+            raise requests.exceptions.InvalidJSONError(str(error)) from error
@@ -0,0 +1,84 @@
+# Request coalescing: concurrent callers for the same key share one fetch
+import concurrent.futures
+import threading
+import lazy_imports
+import metrics
+
+asyncio = lazy_imports.lazy_module("asyncio")
+
+
+class SingleFlight:
+    '''
+    the first caller for a key runs the fetch and everyone who asks for the
+    same key while it is running waits on the same future and gets the same
+    result or exception. Threads and coroutines can wait on each other's
+    fetches because the in-flight future is a concurrent.futures.Future.
+    calls and coalesced count how many requests came in and how many of
+    them were served by a fetch that was already running; they are also
+    reported to metrics as <name>_calls and <name>_coalesced.
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def _join(self, key):
+        with self.lock:
+            self.calls += 1
+            future = self.in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = concurrent.futures.Future()
+                self.in_flight[key] = future
+            else:
+                self.coalesced += 1
+        metrics.increment(f"{self.name}_calls")
+        if not leader:
+            metrics.increment(f"{self.name}_coalesced")
+        return future, leader
+
+    def _finish(self, key, future, result=None, error=None):
+        with self.lock:
+            del self.in_flight[key]
+        if future.cancelled():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn, *args):
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args)
+        except BaseException as error:
+            self._finish(key, future, error=error)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    async def do_async(self, key, coroutine_function, *args):
+        future, leader = self._join(key)
+        if not leader:
+            # shielded, so cancelling one waiter does not cancel the fetch
+            # for the threads and coroutines sharing it
+            return await asyncio.shield(asyncio.wrap_future(future))
+        try:
+            result = await coroutine_function(*args)
+        except BaseException as error:
+            self._finish(key, future, error=error)
+            raise
+        self._finish(key, future, result)
+        return result
+
+    def stats(self):
+        with self.lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self.in_flight)}
+
+
+geocode_flights = SingleFlight("geocode_flight")
+weather_flights = SingleFlight("weather_flight")
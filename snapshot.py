@@ -0,0 +1,225 @@
+# Binary forecast snapshot: fixed-width header and city index, packed columns, read through mmap
+import argparse
+import array
+import collections.abc
+import datetime
+import math
+import mmap
+import os
+import struct
+import sys
+import fastjson
+
+MAGIC = b"WXSNAP\r\n"
+VERSION = 1
+VARIABLES = fastjson.DAILY_FIELDS[1:]
+
+# magic, version, city count, total days over all cities, size of the name block, highest seq
+HEADER = struct.Struct("<8sIIIIq")
+# name offset and length, first day and day count in the columns, latitude, longitude, saved_at, seq
+CITY = struct.Struct("<IIIIdddq")
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _packed(typecode, values):
+    column = array.array(typecode, values)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column.tobytes()
+
+
+def write_snapshot(filename, weather_data, saved_at=None, record_seq=None):
+    '''
+    write the {city: forecast} mapping as a snapshot. Each forecast keeps its
+    coordinates and the daily arrays the app reads; days are stored as date
+    ordinals and missing values as NaN. saved_at and record_seq map cities to
+    the time and sequence number of their record, as in WeatherLog.
+    '''
+    saved_at = saved_at or {}
+    record_seq = record_seq or {}
+    names = bytearray()
+    index = []
+    days = []
+    columns = {name: [] for name in VARIABLES}
+    for city, data in weather_data.items():
+        encoded = city.encode()
+        daily = data.get('daily', {})
+        dates = daily.get('time') or []
+        index.append(CITY.pack(len(names), len(encoded), len(days), len(dates),
+                               _float(data.get('latitude')), _float(data.get('longitude')),
+                               saved_at.get(city, 0.0), record_seq.get(city, 0)))
+        names += encoded
+        days.extend(datetime.date.fromisoformat(day).toordinal() for day in dates)
+        for name in VARIABLES:
+            values = daily.get(name) or []
+            columns[name].extend(_float(values[i]) if i < len(values) else math.nan for i in range(len(dates)))
+
+    header = HEADER.pack(MAGIC, VERSION, len(index), len(days), len(names), max(record_seq.values(), default=0))
+    body = bytearray(header)
+    body += b"".join(index)
+    body += names
+    body += bytes(_align(len(body)) - len(body))
+    body += _packed('i', days)
+    for name in VARIABLES:
+        body += bytes(_align(len(body)) - len(body))
+        body += _packed('d', columns[name])
+
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, 'wb') as file:
+        file.write(body)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_filename, filename)
+
+
+def _float(value):
+    return math.nan if value is None else float(value)
+
+
+def _value(value):
+    return None if math.isnan(value) else value
+
+
+class Snapshot(collections.abc.Mapping):
+    '''
+    a read-only {city: forecast} mapping over a snapshot file. Opening it
+    maps the file and reads the header only; the city index is read the
+    first time a city is looked up and each forecast is decoded from the
+    packed columns when it is asked for. saved_at and record_seq give the
+    stored time and sequence number per city the same way.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise ValueError(f"{filename} is not a forecast snapshot")
+        if len(self.map) < HEADER.size:
+            self.close()
+            raise ValueError(f"{filename} is not a forecast snapshot")
+        magic, version, self.n_cities, self.total_days, names_size, self.max_seq = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError(f"{filename} is not a version {VERSION} forecast snapshot")
+        self.names_start = HEADER.size + self.n_cities * CITY.size
+        self.days_start = _align(self.names_start + names_size)
+        self.columns_start = {}
+        offset = self.days_start + 4 * self.total_days
+        for name in VARIABLES:
+            offset = _align(offset)
+            self.columns_start[name] = offset
+            offset += 8 * self.total_days
+        if len(self.map) < offset:
+            self.close()
+            raise ValueError(f"{filename} is truncated")
+        self.rows = None
+        self.saved_at = _CityField(self, 6)
+        self.record_seq = _CityField(self, 7)
+
+    def _city(self, row):
+        return CITY.unpack_from(self.map, HEADER.size + row * CITY.size)
+
+    def _name(self, city_record):
+        start = self.names_start + city_record[0]
+        return self.map[start:start + city_record[1]].decode()
+
+    def _row(self, city):
+        if self.rows is None:
+            self.rows = {self._name(self._city(row)): row for row in range(self.n_cities)}
+        return self.rows[city]
+
+    def __getitem__(self, city):
+        _, _, first, count, latitude, longitude, _, _ = self._city(self._row(city))
+        ordinals = struct.unpack_from(f"<{count}i", self.map, self.days_start + 4 * first)
+        daily = {"time": [datetime.date.fromordinal(day).isoformat() for day in ordinals]}
+        for name in VARIABLES:
+            values = struct.unpack_from(f"<{count}d", self.map, self.columns_start[name] + 8 * first)
+            daily[name] = [_value(value) for value in values]
+        data = {"daily": daily}
+        if not math.isnan(latitude):
+            data["latitude"], data["longitude"] = latitude, longitude
+        return data
+
+    def __iter__(self):
+        for row in range(self.n_cities):
+            yield self._name(self._city(row))
+
+    def __len__(self):
+        return self.n_cities
+
+    def __contains__(self, city):
+        try:
+            self._row(city)
+        except KeyError:
+            return False
+        return True
+
+    def close(self):
+        if getattr(self, "map", None) is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+class _CityField(collections.abc.Mapping):
+    def __init__(self, snapshot, position):
+        self.snapshot = snapshot
+        self.position = position
+
+    def __getitem__(self, city):
+        return self.snapshot._city(self.snapshot._row(city))[self.position]
+
+    def __iter__(self):
+        return iter(self.snapshot)
+
+    def __len__(self):
+        return len(self.snapshot)
+
+
+def json_to_snapshot(json_filename, snapshot_filename):
+    '''
+    convert a weather_data.json style {city: forecast} file. Its
+    modification time becomes every city's saved_at.
+    '''
+    with open(json_filename, 'rb') as file:
+        weather_data = fastjson.loads(file.read())
+    saved_at = os.path.getmtime(json_filename)
+    write_snapshot(snapshot_filename, weather_data, dict.fromkeys(weather_data, saved_at))
+
+
+def snapshot_to_json(snapshot_filename, json_filename):
+    with Snapshot(snapshot_filename) as snapshot:
+        weather_data = dict(snapshot.items())
+    temp_filename = json_filename + ".tmp"
+    with open(temp_filename, 'w') as file:
+        file.write(fastjson.dumps(weather_data))
+    os.replace(temp_filename, json_filename)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert forecasts between weather_data.json and a binary snapshot.")
+    parser.add_argument("direction", choices=("to-snapshot", "to-json"))
+    parser.add_argument("source")
+    parser.add_argument("target")
+    args = parser.parse_args(argv)
+    if args.direction == "to-snapshot":
+        json_to_snapshot(args.source, args.target)
+    else:
+        snapshot_to_json(args.source, args.target)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
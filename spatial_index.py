@@ -0,0 +1,54 @@
+# Grid index over coordinates for "anything within X km of here?" lookups
+import collections
+import math
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.195
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+class GridIndex:
+    '''
+    points bucketed into cell_deg x cell_deg latitude/longitude cells. A
+    within() query only looks at the cells that can hold a point within the
+    radius, so its cost does not grow with the number of points stored.
+    '''
+    def __init__(self, cell_deg=0.1):
+        self.cell_deg = cell_deg
+        self.cells = collections.defaultdict(dict)
+
+    def _cell(self, latitude, longitude):
+        return math.floor(latitude / self.cell_deg), math.floor(longitude / self.cell_deg)
+
+    def insert(self, latitude, longitude, key):
+        self.cells[self._cell(latitude, longitude)][key] = (latitude, longitude)
+
+    def remove(self, latitude, longitude, key):
+        cell = self._cell(latitude, longitude)
+        self.cells[cell].pop(key, None)
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+    def within(self, latitude, longitude, radius_km):
+        '''
+        [(distance_km, key)] for every point within radius_km, nearest first.
+        '''
+        lat_steps = math.ceil(radius_km / KM_PER_DEGREE / self.cell_deg)
+        cos_lat = max(math.cos(math.radians(min(abs(latitude) + lat_steps * self.cell_deg, 89.9))), 1e-6)
+        lon_steps = math.ceil(radius_km / (KM_PER_DEGREE * cos_lat) / self.cell_deg)
+        row, column = self._cell(latitude, longitude)
+        found = []
+        for cell_row in range(row - lat_steps, row + lat_steps + 1):
+            for cell_column in range(column - lon_steps, column + lon_steps + 1):
+                for key, (lat, lon) in self.cells.get((cell_row, cell_column), {}).items():
+                    distance = haversine_km(latitude, longitude, lat, lon)
+                    if distance <= radius_km:
+                        found.append((distance, key))
+        found.sort(key=lambda item: item[0])
+        return found
@@ -0,0 +1,187 @@
+# Local stand-in for the Open-Meteo geocoding and forecast APIs
+import datetime
+import email.utils
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+def _city_coordinates(name):
+    '''
+    every city name maps to a stable point in the Bay Area so repeated runs
+    see the same answers.
+    '''
+    seed = zlib.crc32(name.encode())
+    return round(36.5 + (seed % 2000) / 1000, 5), round(-123.0 + (seed // 2000 % 1500) / 1000, 5)
+
+
+def geocode_response(name):
+    if name.lower().startswith("nowhere"):
+        return {"generationtime_ms": 0.1}
+    lat, lon = _city_coordinates(name)
+    return {"results": [
+        {"name": name, "latitude": lat + 1, "longitude": lon + 20, "country": "Canada", "admin1": "Ontario"},
+        {"name": name, "latitude": lat, "longitude": lon, "country": "United States", "admin1": "California"},
+    ], "generationtime_ms": 0.1}
+
+
+def forecast_response(latitude, longitude, start_date, end_date, model_run=0):
+    start = datetime.date.fromisoformat(start_date)
+    days = (datetime.date.fromisoformat(end_date) - start).days + 1
+    seed = f"{latitude:.2f},{longitude:.2f},{start_date}" + (f",{model_run}" if model_run else "")
+    rng = random.Random(seed)
+    high = [round(rng.uniform(60, 100), 1) for _ in range(days)]
+    return {
+        "latitude": latitude,
+        "longitude": longitude,
+        "generationtime_ms": round(rng.uniform(0.02, 0.2), 3),
+        "utc_offset_seconds": -25200,
+        "timezone": "America/Los_Angeles",
+        "timezone_abbreviation": "PDT",
+        "elevation": 10.0,
+        "daily_units": {"time": "iso8601", "temperature_2m_max": "°F", "temperature_2m_min": "°F",
+                        "windspeed_10m_max": "mp/h", "uv_index_max": ""},
+        "daily": {
+            "time": [str(start + datetime.timedelta(days=i)) for i in range(days)],
+            "temperature_2m_max": high,
+            "temperature_2m_min": [round(h - rng.uniform(15, 40), 1) for h in high],
+            "windspeed_10m_max": [round(rng.uniform(2, 20), 1) for _ in range(days)],
+            "uv_index_max": [round(rng.uniform(1, 10), 2) for _ in range(days)],
+        },
+    }
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        if server.latency or server.jitter:
+            time.sleep(max(0.0, server.latency + random.uniform(-server.jitter, server.jitter)))
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        with server.lock:
+            server.request_count += 1
+        if server.error_rate and random.random() < server.error_rate:
+            status = random.choice((429, 503))
+            headers = {"Retry-After": str(server.retry_after)} if status == 429 else {}
+            self.send_json(status, {"error": True, "reason": "stub failure"}, headers)
+            return
+        if url.path == "/v1/search":
+            body = geocode_response(query.get("name", ""))
+        elif url.path == "/v1/forecast":
+            latitudes = query["latitude"].split(",")
+            longitudes = query["longitude"].split(",")
+            body = [forecast_response(float(lat), float(lon), query["start_date"], query["end_date"],
+                                      server.model_run)
+                    for lat, lon in zip(latitudes, longitudes)]
+            if len(body) == 1:
+                body = body[0]
+            # like a CDN in front of the API: the ETag follows the forecast values
+            etag = '"%08x"' % zlib.crc32(json.dumps(body["daily"] if isinstance(body, dict) else
+                                                    [location["daily"] for location in body]).encode())
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_json(200, body, {"ETag": etag, "Last-Modified": server.model_run_time})
+            return
+        else:
+            self.send_error(404)
+            return
+        self.send_json(200, body)
+
+    def send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address=("127.0.0.1", 0), latency=0.0, jitter=0.0, error_rate=0.0, retry_after=0):
+        super().__init__(address, StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.new_model_run(0)
+
+    def new_model_run(self, model_run=None):
+        '''
+        pretend a new model run was published, so forecasts (and their ETags)
+        change.
+        '''
+        self.model_run = self.model_run + 1 if model_run is None else model_run
+        self.model_run_time = email.utils.formatdate(usegmt=True)
+
+    def handle_error(self, request, client_address):
+        # clients that time out or cancel drop the connection mid-response
+        pass
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+
+def start_stub_server(latency=0.0, jitter=0.0, port=0, error_rate=0.0, retry_after=0):
+    '''
+    start the stub on a background thread and return it. Point the fetch
+    functions at it with use_stub_server(server). error_rate is the fraction
+    of requests answered with a 429 (carrying Retry-After) or a 503.
+    '''
+    server = StubServer(("127.0.0.1", port), latency=latency, jitter=jitter,
+                        error_rate=error_rate, retry_after=retry_after)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def use_stub_server(server):
+    import transport
+    transport.set_endpoints(f"{server.base_url}/v1/search", f"{server.base_url}/v1/forecast")
+
+
+if __name__ == "__main__":
+    import requests
+    import transport
+
+    server = start_stub_server()
+    use_stub_server(server)
+    url = f"{transport.GEOCODING_URL}?name=Napa&count=10&language=en&format=json"
+    rounds = 300
+
+    start_time = time.perf_counter()
+    for _ in range(rounds):
+        requests.get(url).json()
+    bare_time = (time.perf_counter() - start_time) / rounds
+
+    transport.get_session().get(url).json()
+    start_time = time.perf_counter()
+    for _ in range(rounds):
+        transport.get_session().get(url).json()
+    pooled_time = (time.perf_counter() - start_time) / rounds
+
+    print(f"{'':<20}{'per request (ms)':<20}")
+    print(f"{'requests.get':<20}{bare_time * 1000:<20.3f}")
+    print(f"{'pooled session':<20}{pooled_time * 1000:<20.3f}")
+    server.shutdown()
@@ -0,0 +1,30 @@
+# The modules live at the top of the repository, next to this directory
+import os
+import sys
+import threading
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stub_server
+import transport
+
+
+@pytest.fixture
+def stub():
+    '''
+    a local stub of the Open-Meteo APIs, with transport pointed at it for
+    the duration of the test.
+    '''
+    server = stub_server.StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    endpoints = transport.GEOCODING_URL, transport.FORECAST_URL
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    transport.set_endpoints(base_url + "/v1/search", base_url + "/v1/forecast")
+    try:
+        yield server
+    finally:
+        transport.set_endpoints(*endpoints)
+        server.shutdown()
+        server.server_close()
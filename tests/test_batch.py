@@ -0,0 +1,44 @@
+import pytest
+import batch
+import lab4
+
+LOCATIONS = {
+    "Napa": (38.29714, -122.28553),
+    "Sonoma": (38.29186, -122.45804),
+    "Santa Cruz": (36.97412, -122.0308),
+    "Monterey": (36.60024, -121.89468),
+    "Berkeley": (37.87159, -122.27275),
+}
+
+
+def test_single_location(stub):
+    weather_data = batch.fetch_weather_batch([("Napa", 38.29714, -122.28553)])
+    assert list(weather_data) == ["Napa"]
+    assert weather_data["Napa"]["latitude"] == 38.29714
+    assert len(weather_data["Napa"]["daily"]["time"]) == 5
+    assert stub.request_count == 1
+
+
+def test_many_locations_match_single_requests(stub):
+    chunk = [(city, lat, lon) for city, (lat, lon) in LOCATIONS.items()]
+    weather_data = batch.fetch_weather_batch(chunk)
+    assert stub.request_count == 1
+    assert list(weather_data) == list(LOCATIONS)
+    for city, (lat, lon) in LOCATIONS.items():
+        assert weather_data[city] == lab4.fetch_weather(lat, lon)
+
+
+def test_chunk_boundary(stub):
+    assert [len(chunk) for chunk in batch.chunk_locations(LOCATIONS, 2)] == [2, 2, 1]
+    weather_data = batch.get_weather_data_batched(LOCATIONS, chunk_size=2)
+    assert stub.request_count == 3
+    assert sorted(weather_data) == sorted(LOCATIONS)
+    assert [weather_data[city]["latitude"] for city in LOCATIONS] == [lat for lat, _ in LOCATIONS.values()]
+
+
+def test_length_mismatch():
+    chunk = [("Napa", 38.29714, -122.28553), ("Sonoma", 38.29186, -122.45804)]
+    with pytest.raises(ValueError):
+        batch.split_batch_response(chunk, [{"daily": {}}])
+    with pytest.raises(ValueError):
+        batch.split_batch_response(chunk, {"daily": {}})
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+import columnar
+
+
+def forecast(days, highs, lows=None):
+    return {"daily": {"time": days,
+                      "temperature_2m_max": highs,
+                      "temperature_2m_min": lows if lows is not None else [50.0] * len(days),
+                      "windspeed_10m_max": [5.0] * len(days),
+                      "uv_index_max": [3.0] * len(days)}}
+
+
+@pytest.fixture
+def table():
+    return columnar.ForecastTable.from_weather_data({
+        "Napa": forecast(["2024-05-01", "2024-05-02", "2024-05-03"], [80, 92, 85]),
+        # no forecast for 2024-05-02, and the API left one value out
+        "Fresno": forecast(["2024-05-01", "2024-05-03"], [95, None]),
+        "Sonoma": forecast(["2024-05-03", "2024-05-04"], [70, 72]),
+    })
+
+
+def test_grid_and_missing_days(table):
+    assert table.base_date.isoformat() == "2024-05-01"
+    assert table.dates() == ["2024-05-01", "2024-05-02", "2024-05-03", "2024-05-04"]
+    assert table.present.tolist() == [[True, True, True, False],
+                                      [True, False, True, False],
+                                      [False, False, True, True]]
+    fresno = table.columns["temperature_2m_max"][table.city_index["Fresno"]]
+    assert fresno[0] == 95 and np.isnan(fresno[1:]).all()
+
+
+def test_window(table):
+    window = table.window("temperature_2m_max", "2024-05-02", "2024-05-03")
+    assert window.shape == (3, 2)
+    assert window[0].tolist() == [92, 85]
+    # dates outside the table are clipped to it
+    assert table.window("temperature_2m_max", "2024-04-01", "2024-06-01").shape == (3, 4)
+    assert table.window("temperature_2m_max", "2024-06-01").shape == (3, 0)
+
+
+def test_cities_where(table):
+    assert table.cities_where("temperature_2m_max", ">", 90) == ["Napa", "Fresno"]
+    assert table.cities_where("temperature_2m_max", ">", 90, start_date="2024-05-03") == []
+    assert table.cities_where("temperature_2m_max", "<=", 70) == ["Sonoma"]
+
+
+def test_stats_ignore_missing_days(table):
+    stats = table.stats("temperature_2m_max")
+    assert stats["mean"].tolist()[0] == pytest.approx(257 / 3)
+    assert stats["min"].tolist() == [80, 95, 70]
+    assert stats["max"].tolist() == [92, 95, 72]
+    # Sonoma has nothing in the window
+    window_stats = table.stats("temperature_2m_max", end_date="2024-05-02")
+    assert np.isnan(window_stats["mean"][table.city_index["Sonoma"]])
+
+
+def test_city_forecast_leaves_out_missing_days(table):
+    daily = table.city_forecast("Fresno")["daily"]
+    assert daily["time"] == ["2024-05-01", "2024-05-03"]
+    assert daily["temperature_2m_max"][0] == 95 and np.isnan(daily["temperature_2m_max"][1])
+    assert daily["temperature_2m_min"] == [50.0, 50.0]
+
+
+def test_empty_and_mismatched_input():
+    empty = columnar.ForecastTable.from_weather_data({"Napa": forecast([], [])})
+    assert empty.n_days == 0 and empty.cities_where("temperature_2m_max", ">", 0) == []
+    with pytest.raises(ValueError):
+        columnar.ForecastTable.from_weather_data({"Napa": forecast(["2024-05-01"], [])})
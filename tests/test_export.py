@@ -0,0 +1,42 @@
+import numpy as np
+import export
+
+
+def forecast(days, high):
+    return {"daily": {"time": days,
+                      "temperature_2m_max": [high] * len(days),
+                      "temperature_2m_min": [50.5] * len(days),
+                      "windspeed_10m_max": [None] + [7.2] * (len(days) - 1),
+                      "uv_index_max": [3] * len(days)}}
+
+
+WEATHER_DATA = {
+    "Napa": forecast(["2024-05-01", "2024-05-02"], 70),
+    "Sonoma": forecast(["2024-05-01"], 71),
+    "Fresno": forecast(["2024-09-10", "2024-09-11", "2024-09-12"], 95),
+}
+
+
+def test_txt_layout_keeps_the_stored_values(tmp_path):
+    path, count = export.export(WEATHER_DATA, str(tmp_path / "weather.txt"), chunk_size=2)
+    assert count == 6
+    assert (tmp_path / "weather.txt").read_text().startswith(
+        "Napa:\n2024-05-01,2024-05-02\n70,70\n50.5,50.5\nNone,7.2\n3,3\n\n")
+
+
+def test_npz_is_written_one_chunk_at_a_time(tmp_path):
+    path, count = export.export(WEATHER_DATA, str(tmp_path / "out.parquet"), "parquet", chunk_size=2)
+    assert path.endswith("out.npz") and count == 6
+    chunks = list(export.iter_npz_chunks(path))
+    assert [list(chunk["city"]) for chunk in chunks] == [["Napa", "Napa", "Sonoma"], ["Fresno"] * 3]
+    assert chunks[1]["date"][0] == np.datetime64("2024-09-10")
+    assert list(chunks[1]["temperature_2m_max"]) == [95.0] * 3
+    assert np.isnan(chunks[0]["windspeed_10m_max"][0])
+
+
+def test_incremental_columnar_exports_go_to_part_files(tmp_path):
+    first, _ = export.export({"Napa": WEATHER_DATA["Napa"]}, str(tmp_path / "out.npz"), append=True)
+    second, count = export.export({"Fresno": WEATHER_DATA["Fresno"]}, str(tmp_path / "out.npz"), append=True)
+    assert first.endswith("out.part0001.npz") and second.endswith("out.part0002.npz")
+    assert count == 3
+    assert [list(chunk["city"]) for chunk in export.iter_npz_chunks(first)] == [["Napa", "Napa"]]
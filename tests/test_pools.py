@@ -0,0 +1,24 @@
+import pytest
+import pools
+import scheduler
+
+FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+
+
+def forecast_rate():
+    return scheduler.get_scheduler().bucket(FORECAST_URL).rate
+
+
+def test_parent_and_workers_share_the_quota():
+    rate, _ = scheduler.RATE_LIMITS["api.open-meteo.com"]
+    pools.configure_pools(process_workers=2)
+    try:
+        pool = pools.get_process_pool()
+        worker_rates = [pool.submit(forecast_rate).result() for _ in range(4)]
+        parent_rate = forecast_rate()
+        assert parent_rate == pytest.approx(rate * pools.PARENT_RATE_SHARE)
+        assert worker_rates == [pytest.approx(rate * (1 - pools.PARENT_RATE_SHARE) / 2)] * 4
+        assert parent_rate + 2 * worker_rates[0] == pytest.approx(rate)
+    finally:
+        pools.configure_pools(process_workers=pools.PROCESS_WORKERS)
+    assert forecast_rate() == rate
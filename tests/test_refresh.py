@@ -0,0 +1,59 @@
+import forecast_cache
+import geocode_store
+import prefetch
+import refresh
+
+LOCATIONS = {
+    "Napa": (38.29714, -122.28553),
+    "Sonoma": (38.29186, -122.45804),
+    "Santa Cruz": (36.97412, -122.0308),
+}
+
+
+class CountingCache(forecast_cache.ForecastCache):
+    saves = 0
+
+    def save(self):
+        self.saves += 1
+        super().save()
+
+
+def test_not_modified_refresh_only_touches_entries(stub, tmp_path):
+    cache = CountingCache(str(tmp_path / "cache.json"))
+    assert refresh.refresh_locations(LOCATIONS, cache)["changed"] == 3
+    requests = stub.request_count
+    counts = refresh.refresh_locations(LOCATIONS, cache)
+    assert counts == {"not_modified": 3, "unchanged": 0, "changed": 0, "failed": 0}
+    assert stub.request_count == requests + 3
+    assert cache.saves == 2
+    stub.new_model_run()
+    assert refresh.refresh_locations(LOCATIONS, cache, save=False)["changed"] == 3
+    assert cache.saves == 2
+
+
+def test_failed_fallback_fetch_is_counted(stub, tmp_path, monkeypatch):
+    cache = CountingCache(str(tmp_path / "cache.json"))
+    refresh.refresh_locations(LOCATIONS, cache)
+    fetch = refresh.fetch_forecast_conditional
+
+    def fetch_without_fallback(lat, lon, start_date, end_date, meta=None):
+        if meta is None:
+            raise ConnectionError("upstream down")
+        return fetch(lat, lon, start_date, end_date, meta)
+
+    # every entry is evicted while its conditional request is in flight
+    monkeypatch.setattr(refresh, "fetch_forecast_conditional", fetch_without_fallback)
+    monkeypatch.setattr(cache, "touch", lambda *args, **kwargs: False)
+    counts = refresh.refresh_locations(LOCATIONS, cache)
+    assert counts == {"not_modified": 0, "unchanged": 0, "changed": 0, "failed": 3}
+    assert cache.saves == 1
+
+
+def test_prefetch_round_saves_once(stub, tmp_path):
+    cities = ["Napa", "Sonoma", "Santa Cruz", "Monterey", "Berkeley", "Livermore", "San Mateo"]
+    cache = CountingCache(str(tmp_path / "cache.json"))
+    store = geocode_store.GeocodeStore(str(tmp_path / "geolocations.json"))
+    prefetcher = prefetch.Prefetcher(cities, store, cache, counts=prefetch.RequestCounts(str(tmp_path / "counts.json")))
+    assert prefetcher.warm()["changed"] == 7
+    assert prefetcher.warm()["not_modified"] == 7
+    assert cache.saves == 2
@@ -0,0 +1,79 @@
+import asyncio
+import threading
+import pytest
+import single_flight
+
+
+def test_threads_share_one_call():
+    flights = single_flight.SingleFlight("test_flight")
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def fetch(value):
+        calls.append(value)
+        started.set()
+        release.wait(5)
+        return value * 2
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flights.do("key", fetch, 21)))
+    leader.start()
+    started.wait(5)
+    waiter = threading.Thread(target=lambda: results.append(flights.do("key", fetch, 21)))
+    waiter.start()
+    while flights.stats()["coalesced"] < 1:
+        pass
+    release.set()
+    leader.join(5)
+    waiter.join(5)
+    assert results == [42, 42]
+    assert calls == [21]
+    assert flights.stats() == {"calls": 2, "coalesced": 1, "in_flight": 0}
+
+
+def test_errors_reach_every_caller():
+    flights = single_flight.SingleFlight("test_flight")
+
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    async def main():
+        return await asyncio.gather(flights.do_async("key", fetch), flights.do_async("key", fetch),
+                                    return_exceptions=True)
+
+    outcomes = asyncio.run(main())
+    assert [type(outcome) for outcome in outcomes] == [ValueError, ValueError]
+    assert flights.stats()["in_flight"] == 0
+
+
+def test_cancelled_waiter_does_not_cancel_the_fetch():
+    flights = single_flight.SingleFlight("test_flight")
+    thread_results = []
+
+    async def main():
+        release = asyncio.Event()
+
+        async def fetch():
+            await release.wait()
+            return "forecast"
+
+        leader = asyncio.ensure_future(flights.do_async("key", fetch))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(flights.do_async("key", fetch))
+        thread = threading.Thread(target=lambda: thread_results.append(flights.do("key", None)))
+        thread.start()
+        while flights.stats()["coalesced"] < 2:
+            await asyncio.sleep(0.001)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        release.set()
+        result = await leader
+        await asyncio.get_running_loop().run_in_executor(None, thread.join, 5)
+        return result
+
+    assert asyncio.run(main()) == "forecast"
+    assert thread_results == ["forecast"]
+    assert flights.stats() == {"calls": 3, "coalesced": 2, "in_flight": 0}
@@ -0,0 +1,81 @@
+# Shared HTTP transport for the geocoding and forecast requests
+import datetime
+import os
+import lazy_imports
+
+requests = lazy_imports.lazy_module("requests")
+
+GEOCODING_URL = os.environ.get("GEOCODING_URL", "https://geocoding-api.open-meteo.com/v1/search")
+FORECAST_URL = os.environ.get("FORECAST_URL", "https://api.open-meteo.com/v1/forecast")
+
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 32
+
+_session = None
+_session_pid = None
+
+
+def set_endpoints(geocoding_url, forecast_url):
+    global GEOCODING_URL, FORECAST_URL
+    GEOCODING_URL = geocoding_url
+    FORECAST_URL = forecast_url
+
+
+def configure_pool(pool_connections=None, pool_maxsize=None):
+    '''
+    set the number of hosts to keep pools for and the number of keep-alive
+    connections per host. The current session is dropped so the next request
+    builds a new one with the new sizes.
+    '''
+    global POOL_CONNECTIONS, POOL_MAXSIZE
+    if pool_connections is not None:
+        POOL_CONNECTIONS = pool_connections
+    if pool_maxsize is not None:
+        POOL_MAXSIZE = pool_maxsize
+    close_session()
+
+
+def get_session():
+    '''
+    return the session for this process. Every thread in a process shares
+    one session, a forked or spawned worker process builds its own so
+    sockets are never shared between processes.
+    '''
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _session = session
+        _session_pid = os.getpid()
+    return _session
+
+
+def close_session():
+    global _session, _session_pid
+    if _session is not None and _session_pid == os.getpid():
+        _session.close()
+    _session = None
+    _session_pid = None
+
+
+def geocoding_url(city_name):
+    return f"{GEOCODING_URL}?name={city_name}&count=10&language=en&format=json"
+
+
+def forecast_url(latitude, longitude, start_date, end_date):
+    '''
+    latitude and longitude may be single values or comma-separated lists
+    for a multi-location request.
+    '''
+    return (f"{FORECAST_URL}?"
+            f"latitude={latitude}&longitude={longitude}&"
+            f"daily=temperature_2m_max,temperature_2m_min,windspeed_10m_max,uv_index_max&"
+            f"temperature_unit=fahrenheit&wind_speed_unit=mph&timezone=auto&"
+            f"start_date={start_date}&end_date={end_date}")
+
+
+def forecast_window(days=5):
+    start_date = datetime.datetime.now().date()
+    return start_date, start_date + datetime.timedelta(days=days - 1)
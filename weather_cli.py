@@ -0,0 +1,158 @@
+# Headless bulk forecast runs: city names or coordinates in, JSON Lines out
+import argparse
+import functools
+import fastjson
+import sys
+import async_engine
+import batch
+import forecast_cache
+import geocode_store
+import lab4
+import lab4thread
+import lab4process
+import metrics
+import pools
+import weather_log
+
+BACKENDS = ("serial", "threaded", "process", "asyncio", "batched")
+
+
+def backend_functions(backend, concurrency):
+    '''
+    the (geocode, forecast) pair for a backend, taken from the same modules
+    the Tk apps use.
+    '''
+    if backend == "serial":
+        return lab4.get_geolocations, lab4.get_weather_data
+    if backend == "threaded":
+        pools.configure_pools(thread_workers=concurrency)
+        return lab4thread.get_geolocations_threaded, lab4thread.get_weather_data_threaded
+    if backend == "process":
+        pools.configure_pools(process_workers=concurrency)
+        return lab4process.get_geolocations_multiprocessing, lab4process.get_weather_data_multiprocessing
+    if backend == "asyncio":
+        return (functools.partial(async_engine.get_geolocations_async, concurrency=concurrency),
+                functools.partial(async_engine.get_weather_data_async, concurrency=concurrency))
+    if backend == "batched":
+        pools.configure_pools(thread_workers=concurrency)
+        return (lab4thread.get_geolocations_threaded,
+                functools.partial(lab4thread.get_weather_data_threaded, batch_size=batch.BATCH_SIZE))
+    raise ValueError(f"unknown backend {backend!r}")
+
+
+def backend_streams(backend, concurrency):
+    '''
+    the streaming forecast function for a backend: it takes an iterable of
+    (location, (lat, lon)) and yields (location, forecast) as each finishes.
+    '''
+    if backend == "serial":
+        return lab4.iter_weather_data
+    if backend == "threaded":
+        return lab4thread.iter_weather_data_threaded
+    if backend == "process":
+        return lab4process.iter_weather_data_multiprocessing
+    if backend == "asyncio":
+        return functools.partial(async_engine.iter_weather_data_async, concurrency=concurrency)
+    if backend == "batched":
+        return functools.partial(lab4thread.iter_weather_data_threaded, batch_size=batch.BATCH_SIZE)
+    raise ValueError(f"unknown backend {backend!r}")
+
+
+def parse_location(line):
+    '''
+    "lat,lon" lines are used as coordinates, anything else is a city name.
+    '''
+    parts = line.split(",")
+    if len(parts) == 2:
+        try:
+            return float(parts[0]), float(parts[1])
+        except ValueError:
+            pass
+    return None
+
+
+def read_chunks(lines, chunk_size):
+    chunk = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def run(lines, output, backend="threaded", concurrency=16, chunk_size=500,
+        store=None, cache=None, log=None):
+    '''
+    geocode the locations in lines chunk by chunk, then write one JSON
+    object per location to output as each forecast arrives, so output
+    starts with the first result and memory stays bounded by chunk_size.
+    Returns (written, skipped) counts.
+    '''
+    geocode, _ = backend_functions(backend, concurrency)
+    iter_fetch = backend_streams(backend, concurrency)
+    store = store or geocode_store.GeocodeStore()
+    cache = cache or forecast_cache.ForecastCache()
+    written = skipped = 0
+    for chunk in read_chunks(lines, chunk_size):
+        coordinates = {line: parse_location(line) for line in chunk}
+        names = [line for line, coords in coordinates.items() if coords is None]
+        geolocations = store.resolve(names, geocode) if names else {}
+        geolocations.update({line: coords for line, coords in coordinates.items() if coords is not None})
+        valid_geolocations = lab4.filter_valid_geolocations(geolocations)
+        weather_data = {}
+        for line, forecast in forecast_cache.iter_weather_data_cached(valid_geolocations, cache, iter_fetch):
+            lat, lon = valid_geolocations[line]
+            record = {"location": line, "latitude": lat, "longitude": lon, "forecast": forecast}
+            output.write(fastjson.dumps(record) + "\n")
+            weather_data[line] = forecast
+        output.flush()
+        # one fsync'd append per chunk rather than per location
+        if log is not None:
+            log.append(weather_data)
+        written += len(weather_data)
+        skipped += len(chunk) - len(weather_data)
+    return written, skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fetch 5-day forecasts for a list of cities or lat,lon pairs.")
+    parser.add_argument("input", nargs="?", default="-", help="file with one location per line, - for stdin")
+    parser.add_argument("-o", "--output", default="-", help="JSON Lines output file, - for stdout")
+    parser.add_argument("--backend", choices=BACKENDS, default="threaded")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--cache-ttl", type=float, default=3600)
+    parser.add_argument("--weather-log", help="also append results to this weather log (e.g. weather_data.jsonl)")
+    parser.add_argument("--metrics", help="write stage metrics here (.json for JSON, else Prometheus text)")
+    args = parser.parse_args(argv)
+
+    if args.metrics:
+        metrics.enable()
+        metrics.add_sink(metrics.FileSink(args.metrics, "json" if args.metrics.endswith(".json") else "prometheus"))
+    log = None
+    if args.weather_log:
+        log = weather_log.WeatherLog(args.weather_log, legacy_filename=None)
+        log.load()
+
+    input_file = sys.stdin if args.input == "-" else open(args.input, 'r')
+    output_file = sys.stdout if args.output == "-" else open(args.output, 'w')
+    try:
+        written, skipped = run(input_file, output_file, args.backend, args.concurrency, args.chunk_size,
+                               cache=forecast_cache.ForecastCache(ttl=args.cache_ttl), log=log)
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+    print(f"{written} forecasts written, {skipped} locations skipped", file=sys.stderr)
+    metrics.flush()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
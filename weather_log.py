@@ -0,0 +1,175 @@
+# Append-only JSON Lines storage for forecasts, one record per city per save
+import collections
+import json
+import os
+import threading
+import time
+import metrics
+import fastjson
+import snapshot
+
+WEATHER_LOG_FILE = 'weather_data.jsonl'
+LEGACY_WEATHER_FILE = 'weather_data.json'
+SNAPSHOT_FILE = 'weather_data.snap'
+
+
+class WeatherLog:
+    '''
+    every save appends one line per changed city, so its cost depends only on
+    the new records. The latest record for each city is kept in memory in
+    index. A torn last line left by a crash is cut off when the log is
+    opened, and the log is rewritten without superseded records once they
+    outnumber the live ones compact_ratio to one.
+
+    With snapshot_filename set, compaction writes every city to a binary
+    snapshot instead and empties the log, so the log only holds what changed
+    since. Opening the log then maps the snapshot, which costs the same
+    whatever its size, and replays just those lines on top of it.
+    '''
+    def __init__(self, filename=WEATHER_LOG_FILE, legacy_filename=LEGACY_WEATHER_FILE, compact_ratio=2,
+                 snapshot_filename=None):
+        self.filename = filename
+        self.legacy_filename = legacy_filename
+        self.compact_ratio = compact_ratio
+        self.snapshot_filename = snapshot_filename
+        self.snapshot = None
+        # ChainMaps from the start, so opening a snapshot only swaps their
+        # maps and callers holding index keep seeing every update
+        self.index = collections.ChainMap({})
+        self.saved_at = collections.ChainMap({})
+        self.record_seq = collections.ChainMap({})
+        # len() of a ChainMap walks every key, so the live cities are counted here
+        self.city_count = 0
+        self.seq = 0
+        self.line_count = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        '''
+        read the log into index and return it. The first time, forecasts from
+        the old weather_data.json are carried over into a new log.
+        '''
+        if self.snapshot_filename and os.path.exists(self.snapshot_filename):
+            self._open_snapshot()
+        elif not os.path.exists(self.filename):
+            if self.legacy_filename and os.path.exists(self.legacy_filename):
+                self.migrate_legacy()
+            return self.index
+        if not os.path.exists(self.filename):
+            return self.index
+        good_offset = 0
+        with open(self.filename, 'rb') as file:
+            for line in file:
+                try:
+                    record = fastjson.loads(line)
+                except fastjson.DecodeError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                good_offset += len(line)
+                self._apply(record)
+        if good_offset < os.path.getsize(self.filename):
+            with open(self.filename, 'r+b') as file:
+                file.truncate(good_offset)
+        if self.snapshot_filename and self.snapshot is None and self.line_count:
+            # first run with snapshots on: move the existing log into one
+            self.compact()
+        return self.index
+
+    def _open_snapshot(self):
+        self.snapshot = snapshot.Snapshot(self.snapshot_filename)
+        layers = ((self.index, self.snapshot), (self.saved_at, self.snapshot.saved_at),
+                  (self.record_seq, self.snapshot.record_seq))
+        for chain, base in layers:
+            chain.maps[:] = [{}, base]
+        self.seq = max(self.seq, self.snapshot.max_seq)
+        self.city_count = len(self.snapshot)
+        self.line_count = 0
+
+    def migrate_legacy(self):
+        with open(self.legacy_filename, 'r') as file:
+            weather_data = json.load(file)
+        saved_at = os.path.getmtime(self.legacy_filename)
+        for city, data in weather_data.items():
+            self.seq += 1
+            self._count(city)
+            self.index[city] = data
+            self.saved_at[city] = saved_at
+            self.record_seq[city] = self.seq
+        self.compact()
+
+    def _count(self, city):
+        if city not in self.index:
+            self.city_count += 1
+
+    def _apply(self, record):
+        self._count(record["city"])
+        self.index[record["city"]] = record["data"]
+        self.saved_at[record["city"]] = record["saved_at"]
+        self.record_seq[record["city"]] = record["seq"]
+        self.seq = max(self.seq, record["seq"])
+        self.line_count += 1
+
+    def append(self, weather_data):
+        '''
+        write records for the cities in weather_data whose forecast differs
+        from the one already stored and return how many were written.
+        '''
+        with self.lock, metrics.timer("save_weather_data"):
+            now = time.time()
+            lines = []
+            for city, data in weather_data.items():
+                if self.index.get(city) == data:
+                    continue
+                self.seq += 1
+                record = {"seq": self.seq, "city": city, "saved_at": now, "data": data}
+                lines.append(fastjson.dumps(record) + "\n")
+                self._count(city)
+                self.index[city] = data
+                self.saved_at[city] = now
+                self.record_seq[city] = self.seq
+            if not lines:
+                return 0
+            with open(self.filename, 'a') as file:
+                file.write("".join(lines))
+                file.flush()
+                os.fsync(file.fileno())
+            self.line_count += len(lines)
+            # compaction rewrites every city, log or snapshot alike, so it is
+            # only worth it once the log holds compact_ratio times that many lines
+            if self.line_count > self.compact_ratio * max(self.city_count, 1):
+                self._compact()
+            return len(lines)
+
+    def compact(self):
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        if self.snapshot_filename:
+            self._compact_to_snapshot()
+            return
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, 'w') as file:
+            for city, data in self.index.items():
+                record = {"seq": self.record_seq[city], "city": city, "saved_at": self.saved_at[city],
+                          "data": data}
+                file.write(fastjson.dumps(record) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_filename, self.filename)
+        self.line_count = self.city_count
+
+    def _compact_to_snapshot(self):
+        weather_data = dict(self.index.items())
+        snapshot.write_snapshot(self.snapshot_filename, weather_data, dict(self.saved_at.items()),
+                                dict(self.record_seq.items()))
+        # the snapshot is in place before the log is emptied; a crash in
+        # between only means the same records are replayed over it
+        with open(self.filename, 'w') as file:
+            file.flush()
+            os.fsync(file.fileno())
+        old_snapshot = self.snapshot
+        self._open_snapshot()
+        if old_snapshot is not None:
+            old_snapshot.close()